@@ -0,0 +1,222 @@
+import asyncio
+import random
+import re
+import time
+
+import asyncpg
+
+from pgdatadiff.pgdatadiff import GET_CATALOG_SQL, GET_HISTOGRAM_SQL, \
+    HASH_ALGORITHMS, MULTISET_DIGEST_SQL, ChunkScan, TableInfo, \
+    combine_ranges, compare_counts, compare_digests, describe_counts, \
+    diff_estimates, format_key, initial_chunk_size, partition_bounds, \
+    quote_ident, read_chunk, split_ranges
+
+
+def to_positional(statement, params):
+    # asyncpg takes $1, $2... where the shared SQL templates use :name,
+    # found the way SQLAlchemy does, so that casts and array slices such as
+    # x::int2[] or [0:n] are left alone
+    names = []
+
+    def placeholder(match):
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return f'${names.index(match.group(1)) + 1}'
+
+    statement = re.sub(r'(?<![:\w\\]):(\w+)(?!:)', placeholder, statement)
+    return statement, [params[name] for name in names]
+
+
+# compares tables the way DBDiff does, chunk by chunk with the same
+# ChunkScan, with the options of DBDiff listed here. The others, e.g.
+# bisect, rows, repair_dir, strategy, checkpoint_file, consistent or
+# wait_for_replica, are rejected.
+class AsyncDBDiff(object):
+
+    def __init__(self, firstdb, seconddb, chunk_size=100000, count_only=False,
+                 count_estimate=False, jobs=10, partitions=1,
+                 keep_going=False, hash_algo='md5', schemas=None,
+                 all_schemas=False, max_connections=20,
+                 max_connections_first=None, max_connections_second=None,
+                 statement_timeout='0', lock_timeout='0', **unsupported):
+        if unsupported:
+            raise ValueError(f"AsyncDBDiff does not support "
+                             f"{', '.join(sorted(unsupported))}")
+        self.firstdb = firstdb
+        self.seconddb = seconddb
+        # None means the chunk size is picked per table, as by DBDiff
+        self.chunk_size = None if chunk_size == 'auto' else int(chunk_size)
+        self.count_only = count_only
+        self.count_estimate = count_estimate
+        self.jobs = int(jobs)
+        self.partitions = int(partitions)
+        self.keep_going = keep_going
+        self.hash_expr = HASH_ALGORITHMS[hash_algo]
+        self.schemas = list(schemas or ['public'])
+        self.all_schemas = all_schemas
+        # the number of queries in flight on each database
+        self.max_connections = int(max_connections)
+        self.max_connections_first = int(
+            max_connections_first or max_connections)
+        self.max_connections_second = int(
+            max_connections_second or max_connections)
+        self.server_settings = {
+            'default_transaction_read_only': 'on',
+            'statement_timeout': str(statement_timeout),
+            'lock_timeout': str(lock_timeout)}
+        self.firstpool = None
+        self.secondpool = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def connect(self):
+        self.firstpool, self.secondpool = await asyncio.gather(*(
+            asyncpg.create_pool(
+                db, min_size=size, max_size=size,
+                server_settings=self.server_settings)
+            for db, size in ((self.firstdb, self.max_connections_first),
+                             (self.seconddb, self.max_connections_second))))
+        self.firstcatalog, self.secondcatalog = (
+            {f'{row[0]}.{row[1]}': TableInfo(*row) for row in rows}
+            for rows in await self.fetch_both(GET_CATALOG_SQL, {
+                'schemas': self.schemas, 'all_schemas': self.all_schemas}))
+
+    async def close(self):
+        await asyncio.gather(self.firstpool.close(), self.secondpool.close())
+
+    async def fetch_both(self, statement, params=None, context=None):
+        statement, args = to_positional(statement, params or {})
+        suffix = f' ({context})' if context else ''
+        return await asyncio.gather(
+            retry(lambda: self.firstpool.fetch(statement, *args),
+                  'first database' + suffix),
+            retry(lambda: self.secondpool.fetch(statement, *args),
+                  'second database' + suffix))
+
+    async def diff_table_data(self, tablename):
+        if tablename not in self.secondcatalog:
+            return False, "table is missing"
+        firsttable = self.firstcatalog[tablename]
+        secondtable = self.secondcatalog[tablename]
+
+        if self.count_estimate:
+            return diff_estimates(firsttable, secondtable)
+
+        if self.count_only is True:
+            firstrows, secondrows = await self.fetch_both(
+                f"SELECT count(*) FROM {firsttable.qualified};")
+            return compare_counts(firstrows[0][0], secondrows[0][0])
+
+        if not firsttable.pks:
+            firstrows, secondrows = await self.fetch_both(
+                MULTISET_DIGEST_SQL.format(
+                    relation=firsttable.qualified, where_expr='true'))
+            result, message = compare_digests(firstrows[0], secondrows[0])
+            return result, f"no unique key; {message}"
+
+        if self.partitions > 1:
+            ranges = await self.get_partition_ranges(firsttable)
+        else:
+            ranges = [(None, None)]
+        results = await asyncio.gather(*(
+            self.diff_table_range(firsttable, lower, upper)
+            for lower, upper in ranges))
+        if len(ranges) == 1:
+            return results[0]
+        return combine_ranges(ranges, results)
+
+    async def diff_table_range(self, table, lower=None, upper=None):
+        # the loop of DBDiff.diff_table_range, without its options that
+        # AsyncDBDiff does not support
+        scan = ChunkScan(table.qualified, table.pks, self.hash_expr,
+                         self.chunk_size or initial_chunk_size(table),
+                         lower, upper, auto=self.chunk_size is None)
+        while not scan.done:
+            statement, params = scan.next_query()
+            started = time.monotonic()
+            try:
+                (firstrow,), (secondrow,) = await self.fetch_both(
+                    statement, params,
+                    f"{table.qualified} after key "
+                    f"{format_key(scan.last_key)}")
+            except RETRY_ERRORS as ex:
+                return False, scan.gave_up(ex)
+            scan.timed(time.monotonic() - started)
+            first, second = read_chunk(firstrow), read_chunk(secondrow)
+
+            if self.keep_going and first != second:
+                scan.differ(first, second, scan.upper_key(first, second),
+                            describe_counts(first, second))
+                continue
+
+            failure = scan.check(first, second, params)
+            if failure:
+                return False, failure
+            scan.advance(first)
+        return scan.result()
+
+    async def get_partition_ranges(self, table):
+        # same as DBDiff.get_partition_ranges
+        column = table.pks[0]
+        coltype = table.types[table.columns.index(column)]
+        statement, args = to_positional(
+            GET_HISTOGRAM_SQL.format(coltype=coltype),
+            {'schema': table.schema, 'table': table.name, 'column': column})
+        values = [x[0] for x in await retry(
+            lambda: self.firstpool.fetch(statement, *args), 'first database')]
+
+        if values:
+            bounds = partition_bounds(values, self.partitions)
+        else:
+            low, high = await retry(lambda: self.firstpool.fetchrow(
+                f"SELECT min({quote_ident(column)}), "
+                f"max({quote_ident(column)}) FROM {table.qualified};"),
+                'first database')
+            if not isinstance(low, int) or not isinstance(high, int):
+                return [(None, None)]
+            bounds = [low + (high - low) * i // self.partitions
+                      for i in range(1, self.partitions)]
+        return split_ranges(bounds)
+
+    async def diff_all_table_data(self):
+        # returns (result, message) by table, in table order
+        semaphore = asyncio.Semaphore(self.jobs)
+
+        async def diff(tablename):
+            async with semaphore:
+                return await self.diff_table_data(tablename)
+
+        tables = sorted(self.firstcatalog)
+        results = await asyncio.gather(*map(diff, tables))
+        return dict(zip(tables, results))
+
+
+RETRY_ERRORS = (OSError, asyncpg.PostgresConnectionError,
+                asyncpg.exceptions.OperatorInterventionError,
+                asyncpg.exceptions.LockNotAvailableError)
+
+
+async def retry(fn, name='database'):
+    i = 0
+    max_tries = 3
+    base_timeout = 1
+    while True:
+        try:
+            return await fn()
+        except RETRY_ERRORS as ex:
+            print(f'operational error running query on {name}:', ex)
+            if i < max_tries:
+                delay = random.uniform(0.5, 1) * 2**i * base_timeout
+                print(
+                    f'Attempt {i+1} of {max_tries}, '
+                    f'retrying in {delay:.1f} secs.'
+                )
+                await asyncio.sleep(delay)
+            else:
+                raise
+            i += 1
@@ -0,0 +1,188 @@
+import queue
+import re
+import struct
+import threading
+import uuid
+
+COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+
+# how many batches of COPY data of one side may wait to be merged
+COPY_QUEUE_SIZE = 16
+COPY_BATCH_SIZE = 256 * 1024
+
+# primary key types whose binary representation is decoded, into values
+# ordered the same way as by ORDER BY (COLLATE "C" for text) and equal to
+# the ones psycopg2 returns
+KEY_DECODERS = {
+    'smallint': lambda data: struct.unpack('!h', data)[0],
+    'integer': lambda data: struct.unpack('!i', data)[0],
+    'bigint': lambda data: struct.unpack('!q', data)[0],
+    'uuid': lambda data: str(uuid.UUID(bytes=data)),
+    'text': lambda data: data.decode(),
+    'character varying': lambda data: data.decode(),
+}
+
+
+def key_decoders(table, pks):
+    # None when a key column has a type that cannot be decoded
+    types = [table.types[table.columns.index(pk)].split('(')[0]
+             for pk in pks]
+    if not all(coltype in KEY_DECODERS for coltype in types):
+        return None
+    return [KEY_DECODERS[coltype] for coltype in types]
+
+
+def to_pyformat(statement):
+    # psycopg2 takes %(name)s where the SQL templates use :name
+    return re.sub(r'(?<!:):(\w+)', r'%(\1)s', statement.replace('%', '%%'))
+
+
+class QueueWriter(object):
+    # psycopg2 writes COPY data a row at a time, which is batched into
+    # COPY_BATCH_SIZE bytes to go through the queue
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.pending = []
+        self.size = 0
+
+    def write(self, data):
+        self.pending.append(data)
+        self.size += len(data)
+        if self.size >= COPY_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.chunks.put(b''.join(self.pending))
+        self.pending = []
+        self.size = 0
+
+
+unpack_count = struct.Struct('!h').unpack_from
+unpack_length = struct.Struct('!i').unpack_from
+
+
+def split_values(data):
+    # the values of a row as yielded by copy_rows
+    values = []
+    offset = 0
+    while offset < len(data):
+        (length,) = unpack_length(data, offset)
+        offset += 4
+        if length == -1:
+            values.append(None)
+            continue
+        values.append(data[offset:offset + length])
+        offset += length
+    return tuple(values)
+
+
+def parse_copy(chunks, decoders):
+    # (key, values) of every row of binary COPY data, coming in chunks cut
+    # anywhere. Only the key is decoded, the values are left as sent by the
+    # server, see split_values.
+    key_length = len(decoders)
+    buffer = b''
+    offset = 0
+    header = True
+    for chunk in chunks:
+        buffer = buffer[offset:] + chunk
+        offset = 0
+        if header:
+            # the signature, flags and header extension
+            if len(buffer) < len(COPY_SIGNATURE) + 8:
+                continue
+            if not buffer.startswith(COPY_SIGNATURE):
+                raise ValueError('not a binary COPY')
+            (extension_length,) = struct.unpack_from(
+                '!i', buffer, len(COPY_SIGNATURE) + 4)
+            offset = len(COPY_SIGNATURE) + 8 + extension_length
+            if offset > len(buffer):
+                offset = 0
+                continue
+            header = False
+        end = len(buffer)
+        while offset + 2 <= end:
+            row = offset
+            (count,) = unpack_count(buffer, offset)
+            if count == -1:
+                return
+            offset += 2
+            key = []
+            values = None
+            for index in range(count):
+                if index == key_length:
+                    values = offset
+                if offset + 4 > end:
+                    break
+                (length,) = unpack_length(buffer, offset)
+                offset += 4
+                if length == -1:
+                    # NULL, which a key never is
+                    continue
+                offset += length
+                if offset > end:
+                    break
+                if index < key_length:
+                    key.append(decoders[index](buffer[offset - length:offset]))
+            else:
+                yield tuple(key), buffer[values:offset]
+                continue
+            # the rest of the row is in the next chunk
+            offset = row
+            break
+    raise EOFError('COPY data ended in the middle of a row')
+
+
+def copy_rows(connection, statement, params, decoders):
+    # (key, values) of every row selected by statement, read with a binary
+    # COPY by a thread of its own, see parse_copy.
+    chunks = queue.Queue(COPY_QUEUE_SIZE)
+
+    def produce():
+        try:
+            cursor = connection.cursor()
+            writer = QueueWriter(chunks)
+            cursor.copy_expert(
+                b'COPY (' + cursor.mogrify(to_pyformat(statement), params) +
+                b') TO STDOUT (FORMAT binary)', writer)
+            writer.flush()
+            cursor.close()
+            chunks.put(None)
+        except Exception as ex:
+            chunks.put(ex)
+
+    ended = False
+
+    def receive():
+        # the chunks up to the end of the COPY, or its error
+        nonlocal ended
+        while True:
+            chunk = chunks.get()
+            if chunk is None or isinstance(chunk, Exception):
+                ended = True
+                if chunk is None:
+                    return
+                raise chunk
+            yield chunk
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    complete = False
+    try:
+        yield from parse_copy(receive(), decoders)
+        complete = True
+    finally:
+        # when the rows are not all read, the COPY is cancelled and the
+        # queue drained, so the producer is never left waiting on a full
+        # queue, nor the connection in the middle of a COPY
+        if not ended:
+            if not complete:
+                connection.cancel()
+            try:
+                for _ in receive():
+                    pass
+            except Exception:
+                pass
+        thread.join()
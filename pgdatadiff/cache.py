@@ -0,0 +1,88 @@
+import sqlite3
+import threading
+
+from pgdatadiff import jsonkeys
+
+# bumped when the tables change, which drops the ones of older versions
+CACHE_VERSION = 3
+
+
+def encode_key(key):
+    return jsonkeys.dumps(None if key is None else list(key))
+
+
+# chunks found identical by previous runs, looked up by pair of databases, by
+# table, by the bounds of the --partitions range they are in and by the key
+# they start after, so a run can jump over them as long as the watermark of
+# their table is unchanged. The first chunk of every range starts after no
+# key, hence the bounds.
+class ChunkCache(object):
+
+    def __init__(self, path, databases):
+        # databases tells both compared databases apart from any other
+        self.databases = databases
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            version = self.connection.execute(
+                "PRAGMA user_version").fetchone()[0]
+            if version < CACHE_VERSION:
+                self.connection.execute("DROP TABLE IF EXISTS watermarks")
+                self.connection.execute("DROP TABLE IF EXISTS chunks")
+                self.connection.execute(
+                    f"PRAGMA user_version = {CACHE_VERSION}")
+            self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS watermarks (
+                databases TEXT,
+                tablename TEXT,
+                watermark TEXT,
+                PRIMARY KEY (databases, tablename)
+            )""")
+            self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS chunks (
+                databases TEXT,
+                tablename TEXT,
+                bounds TEXT,
+                lower_key TEXT,
+                upper_key TEXT,
+                hash TEXT,
+                count INTEGER,
+                PRIMARY KEY (databases, tablename, bounds, lower_key)
+            )""")
+
+    def open_table(self, tablename, watermark):
+        # forget the chunks of a table that was updated, deleted from or
+        # rewritten since they were cached
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                "SELECT watermark FROM watermarks"
+                " WHERE databases = ? AND tablename = ?",
+                (self.databases, tablename)).fetchone()
+            if row is not None and row[0] == watermark:
+                return
+            self.connection.execute(
+                "DELETE FROM chunks WHERE databases = ? AND tablename = ?",
+                (self.databases, tablename))
+            self.connection.execute(
+                "INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?)",
+                (self.databases, tablename, watermark))
+
+    def get(self, tablename, bounds, lower_key):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT upper_key, count FROM chunks"
+                " WHERE databases = ? AND tablename = ? AND bounds = ?"
+                " AND lower_key = ?",
+                (self.databases, tablename, encode_key(bounds),
+                 encode_key(lower_key))
+            ).fetchone()
+        if row is None:
+            return None
+        return jsonkeys.loads(row[0]), row[1]
+
+    def put(self, tablename, bounds, lower_key, upper_key, hash, count):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self.databases, tablename, encode_key(bounds),
+                 encode_key(lower_key), encode_key(upper_key), hash, count))
@@ -0,0 +1,103 @@
+import os
+import threading
+import time
+
+from pgdatadiff import jsonkeys
+
+# the progress of ranges is saved at most every SAVE_INTERVAL seconds, the
+# result of a table and its ranges as soon as they are known
+SAVE_INTERVAL = 5
+
+
+def range_name(tablename, lower, upper):
+    return jsonkeys.dumps([tablename, lower, upper])
+
+
+# the progress of a run: the result of every table compared so far and, for
+# the tables being compared, how far each of their ranges got. It is
+# rewritten every few seconds, so that an interrupted run can be resumed
+# from one of its last confirmed chunks.
+class Checkpoint(object):
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.lock = threading.Lock()
+        # the file is written under a lock of its own, so that workers only
+        # wait for each other to update the state, not to write it
+        self.save_lock = threading.Lock()
+        self.version = 0
+        self.saved_version = 0
+        self.saved_at = time.monotonic()
+        self.state = {'tables': {}, 'ranges': {}, 'progress': {}}
+        if resume and os.path.exists(path):
+            with open(path) as f:
+                self.state = jsonkeys.loads(f.read())
+
+    def changed(self, now=False):
+        # called with self.lock held, returns what save writes, None when
+        # the last save is too recent
+        self.version += 1
+        if not now and time.monotonic() - self.saved_at < SAVE_INTERVAL:
+            return None
+        self.saved_at = time.monotonic()
+        return self.version, jsonkeys.dumps(self.state)
+
+    def save(self, snapshot):
+        if snapshot is None:
+            return
+        version, data = snapshot
+        with self.save_lock:
+            # a newer state may have been written in the meantime
+            if version <= self.saved_version:
+                return
+            # written aside then renamed, so a crash never leaves half a
+            # file
+            temporary = self.path + '.tmp'
+            with open(temporary, 'w') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary, self.path)
+            self.saved_version = version
+
+    def remove(self):
+        with self.lock, self.save_lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def get_table(self, tablename):
+        with self.lock:
+            return self.state['tables'].get(tablename)
+
+    def put_table(self, tablename, result, message):
+        with self.lock:
+            self.state['tables'][tablename] = [result, message]
+            for name in [name for name in self.state['progress']
+                         if jsonkeys.loads(name)[0] == tablename]:
+                del self.state['progress'][name]
+            snapshot = self.changed(now=True)
+        self.save(snapshot)
+
+    def get_ranges(self, tablename):
+        # partition bounds come from statistics that may have changed since,
+        # so a resumed table keeps the ranges it was started with
+        with self.lock:
+            return self.state['ranges'].get(tablename)
+
+    def put_ranges(self, tablename, ranges):
+        with self.lock:
+            self.state['ranges'][tablename] = ranges
+            snapshot = self.changed(now=True)
+        self.save(snapshot)
+
+    def get_progress(self, tablename, lower, upper):
+        with self.lock:
+            return self.state['progress'].get(
+                range_name(tablename, lower, upper))
+
+    def put_progress(self, tablename, lower, upper, progress):
+        with self.lock:
+            self.state['progress'][range_name(tablename, lower, upper)] = \
+                progress
+            snapshot = self.changed()
+        self.save(snapshot)
@@ -0,0 +1,71 @@
+import datetime
+import decimal
+import json
+import uuid
+
+# JSON for checkpoints and the cache, whose keys must be read back as the
+# same values to send to the database. Values JSON has no type for are
+# tagged, e.g. {"$type": "bytea", "value": "00ff"}; other types are refused
+# rather than saved as strings that would not compare equal to the keys.
+DECODERS = {
+    'bytea': bytes.fromhex,
+    'date': lambda value: datetime.date(*value),
+    'time': lambda value: datetime.time(
+        *value[:4], tzinfo=decode_offset(value[4])),
+    'timestamp': lambda value: datetime.datetime(
+        *value[:7], tzinfo=decode_offset(value[7])),
+    'interval': lambda value: datetime.timedelta(*value),
+    'uuid': uuid.UUID,
+    'numeric': decimal.Decimal,
+}
+
+
+def encode_offset(value):
+    offset = value.utcoffset()
+    return None if offset is None else offset.total_seconds()
+
+
+def decode_offset(seconds):
+    if seconds is None:
+        return None
+    return datetime.timezone(datetime.timedelta(seconds=seconds))
+
+
+def encode(value):
+    if isinstance(value, (bytes, memoryview)):
+        tag, value = 'bytea', bytes(value).hex()
+    # datetime before date, which it is a subclass of
+    elif isinstance(value, datetime.datetime):
+        tag, value = 'timestamp', [
+            value.year, value.month, value.day, value.hour, value.minute,
+            value.second, value.microsecond, encode_offset(value)]
+    elif isinstance(value, datetime.date):
+        tag, value = 'date', [value.year, value.month, value.day]
+    elif isinstance(value, datetime.time):
+        tag, value = 'time', [
+            value.hour, value.minute, value.second, value.microsecond,
+            encode_offset(value)]
+    elif isinstance(value, datetime.timedelta):
+        tag, value = 'interval', [
+            value.days, value.seconds, value.microseconds]
+    elif isinstance(value, uuid.UUID):
+        tag, value = 'uuid', str(value)
+    elif isinstance(value, decimal.Decimal):
+        tag, value = 'numeric', str(value)
+    else:
+        raise TypeError(f"cannot save a key of type {type(value).__name__}")
+    return {'$type': tag, 'value': value}
+
+
+def decode(obj):
+    if '$type' in obj:
+        return DECODERS[obj['$type']](obj['value'])
+    return obj
+
+
+def dumps(value):
+    return json.dumps(value, default=encode)
+
+
+def loads(data):
+    return json.loads(data, object_hook=decode)
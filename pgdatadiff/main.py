@@ -1,6 +1,6 @@
 """
 Usage:
-  pgdatadiff --firstdb=<firstconnectionstring> --seconddb=<secondconnectionstring> [--only-data|--only-sequences] [--count-only] [--chunk-size=<size>]
+  pgdatadiff --firstdb=<firstconnectionstring> --seconddb=<secondconnectionstring> [--only-data|--only-sequences] [--count-only|--count-estimate] [--chunk-size=<size>] [--strategy=<strategy>] [--jobs=<n>] [--partitions=<n>] [--bisect|--rows [--copy]] [--repair=<dir> [--batch-size=<n>]] [--leaf-size=<size>] [--keep-going] [--hash-algo=<algo>] [--incremental] [--cache=<file>] [--schema=<schema>...|--all-schemas] [--max-connections-first=<n>] [--max-connections-second=<n>] [--statement-timeout=<time>] [--lock-timeout=<time>] [--checkpoint=<file> [--resume]] [--consistent [--align-lsn]|--wait-for-replica]
   pgdatadiff --version
 
 Options:
@@ -11,13 +11,73 @@ Options:
   --only-data        Only compare data, exclude sequences
   --only-sequences   Only compare seqences, exclude data
   --count-only       Do a quick test based on counts alone
-  --chunk-size=100000       The chunk size when comparing data [default: 100000]
+  --count-estimate   Only compare the planner's row estimates, read in a
+                     single query per database
+  --chunk-size=100000       The chunk size when comparing data, or auto to
+                            adjust it per table [default: 100000]
+  --strategy=keyset  How tables are split into chunks: keyset, by ranges of
+                     keys, or ctid, by ranges of heap blocks hashed in
+                     parallel (--partitions at a time) with TID range
+                     scans (PostgreSQL 14+). ctid is only for physical
+                     replicas, whose rows are in the same blocks
+                     [default: keyset]
+  --jobs=1           The number of tables to compare in parallel [default: 1]
+  --partitions=1     Split each table into that many primary key ranges
+                     and compare them in parallel [default: 1]
+  --bisect           Narrow a different chunk down to the differing rows
+  --rows             List the missing, extra and changed rows of a
+                     different chunk, reading both sides in key order
+  --copy             With --rows, read rows with a binary COPY and compare
+                     them without decoding them, when the key columns are
+                     integers, uuids or text
+  --repair=<dir>     Write, for each different table, a script to run on
+                     the second DB to make it match the first one, and
+                     the rows it needs. Implies --keep-going, and --rows
+                     without --bisect
+  --batch-size=1000  The number of rows per statement of the repair
+                     scripts [default: 1000]
+  --leaf-size=100    The number of rows below which --bisect compares
+                     rows one by one [default: 100]
+  --keep-going       Report every different chunk of a table instead of
+                     stopping at the first one
+  --hash-algo=md5    How chunks are hashed: md5, md5-string, sum (PostgreSQL
+                     11+) or xor (PostgreSQL 14+). sum and xor use constant
+                     memory on the server [default: md5]
+  --incremental      Skip chunks that were identical in a previous run and
+                     whose table had no updates or deletes since
+  --cache=pgdatadiff-cache.sqlite  Where --incremental keeps identical
+                     chunks, use one file per pair of databases
+                     [default: pgdatadiff-cache.sqlite]
+  --schema=public    A schema to compare, can be repeated. Only public
+                     is compared when no schema is given
+  --all-schemas      Compare every schema but the system ones
+  --max-connections-first=<n>   The most connections to open to the first
+                     DB, one per job and partition by default
+  --max-connections-second=<n>  The most connections to open to the second
+                     DB, one per job and partition by default
+  --statement-timeout=0  How long a single chunk may run before it is
+                     cancelled and retried, e.g. 30s or 5min. 0 means no
+                     limit [default: 0]
+  --lock-timeout=0   How long to wait for a lock on a table, e.g. when
+                     it is being altered, before retrying [default: 0]
+  --checkpoint=<file>  Save the progress of the run to that file every
+                     few seconds and after every table. It is removed
+                     once all tables are done
+  --resume           Carry on from the progress saved by --checkpoint
+  --consistent       Compare each database as of a single point in time,
+                     shared by all jobs and partitions
+  --align-lsn        With --consistent and a second DB replicating the
+                     first, wait for it to replay up to the point in time
+                     of the first one before taking its own
+  --wait-for-replica  When a chunk differs and the second DB replicates
+                     the first, wait for it to catch up with the first
+                     one and compare the chunk again
 """
 
 import pkg_resources
 from fabulous.color import red
 
-from pgdatadiff.pgdatadiff import DBDiff
+from pgdatadiff.pgdatadiff import DBDiff, HASH_ALGORITHMS, STRATEGIES
 from docopt import docopt
 
 
@@ -30,18 +90,68 @@ def main():
             not second_db_connection_string.startswith("postgres://"):
         print(red("Only Postgres DBs are supported"))
         return 1
+    if arguments['--hash-algo'] not in HASH_ALGORITHMS:
+        print(red(f"Unknown hash algorithm {arguments['--hash-algo']}"))
+        return 1
+    if arguments['--strategy'] not in STRATEGIES:
+        print(red(f"Unknown strategy {arguments['--strategy']}"))
+        return 1
+    if arguments['--strategy'] == 'ctid':
+        for option in ('--bisect', '--rows', '--repair', '--incremental'):
+            if arguments[option]:
+                print(red(f"{option} does not work with --strategy=ctid"))
+                return 1
+    if arguments['--resume'] and not arguments['--checkpoint']:
+        print(red("--resume needs --checkpoint"))
+        return 1
+    if int(arguments['--leaf-size']) < 1:
+        print(red("--leaf-size must be at least 1"))
+        return 1
+
+    try:
+        differ = DBDiff(
+            first_db_connection_string, second_db_connection_string,
+            chunk_size=arguments['--chunk-size'],
+            count_only=arguments['--count-only'],
+            count_estimate=arguments['--count-estimate'],
+            jobs=arguments['--jobs'],
+            partitions=arguments['--partitions'],
+            bisect=arguments['--bisect'],
+            rows=arguments['--rows'],
+            copy=arguments['--copy'],
+            repair_dir=arguments['--repair'],
+            batch_size=arguments['--batch-size'],
+            strategy=arguments['--strategy'],
+            leaf_size=arguments['--leaf-size'],
+            keep_going=arguments['--keep-going'],
+            hash_algo=arguments['--hash-algo'],
+            cache_file=arguments['--incremental'] and arguments['--cache'],
+            schemas=arguments['--schema'],
+            all_schemas=arguments['--all-schemas'],
+            max_connections_first=arguments['--max-connections-first'],
+            max_connections_second=arguments['--max-connections-second'],
+            statement_timeout=arguments['--statement-timeout'],
+            lock_timeout=arguments['--lock-timeout'],
+            checkpoint_file=arguments['--checkpoint'],
+            resume=arguments['--resume'],
+            consistent=arguments['--consistent'],
+            align_lsn=arguments['--align-lsn'],
+            wait_for_replica=arguments['--wait-for-replica'])
+    except ValueError as ex:
+        # options the databases do not support
+        print(red(str(ex)))
+        return 1
 
-    differ = DBDiff(first_db_connection_string, second_db_connection_string,
-                    chunk_size=arguments['--chunk-size'],
-                    count_only=arguments['--count-only'])
-
-    if not arguments['--only-sequences']:
-        if differ.diff_all_table_data():
-            return 1
-    if not arguments['--only-data']:
-        if differ.diff_all_sequences():
-            return 1
-    return 0
+    try:
+        if not arguments['--only-sequences']:
+            if differ.diff_all_table_data():
+                return 1
+        if not arguments['--only-data']:
+            if differ.diff_all_sequences():
+                return 1
+        return 0
+    finally:
+        differ.print_pool_stats()
 
 
 if __name__ == '__main__':
@@ -1,175 +1,954 @@
+import copy
+import hashlib
+import random
+import re
 import sys
-import warnings
+import threading
 import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
 
 from fabulous.color import bold, green, red
 from halo import Halo
 from psycopg2 import DatabaseError
-from sqlalchemy import exc as sa_exc
+from sqlalchemy import event, text
 from sqlalchemy.engine import create_engine
-from sqlalchemy.exc import NoSuchTableError, ProgrammingError, OperationalError
-from sqlalchemy.inspection import inspect
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm.session import sessionmaker
-from sqlalchemy.sql.schema import MetaData, Table
+from sqlalchemy.pool import NullPool
 
+from pgdatadiff.binarycopy import copy_rows, key_decoders, split_values
+from pgdatadiff.cache import ChunkCache
+from pgdatadiff.checkpoint import Checkpoint
+from pgdatadiff.pool import StatsPool, prewarm
+from pgdatadiff.repair import Repair
 
-def make_session(connection_string):
-    engine = create_engine(connection_string, echo=False,
-                           convert_unicode=True)
+# first and second are the values of the row on each side, when known
+RowDiff = namedtuple('RowDiff', ['kind', 'key', 'first', 'second'])
+
+TableInfo = namedtuple(
+    'TableInfo', ['schema', 'name', 'qualified', 'columns', 'types', 'pks',
+                  'reltuples', 'width', 'portable'])
+
+# the schemas to compare, either :schemas or every user schema
+SCHEMA_FILTER = """(
+    n.nspname = ANY(:schemas) OR :all_schemas
+    AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+    AND n.nspname NOT LIKE 'pg\\_%'
+)"""
+
+# everything diff_table_data needs to know about every table, in one query.
+# qualified is the quoted schema.table name to use in SQL. pks are the
+# columns of the primary key or, when there is none, of the unique index
+# on NOT NULL columns with the fewest and narrowest columns, leaving out
+# their INCLUDE columns (past indnkeyatts, PostgreSQL 11+). portable is
+# false when the binary form of a column embeds the OIDs of types that are
+# not built in (16384 being the first OID of user objects), i.e. arrays and
+# composites of user types, whose OIDs differ between databases.
+GET_CATALOG_SQL = f"""
+SELECT
+    n.nspname,
+    c.relname,
+    format('%I.%I', n.nspname, c.relname),
+    array_agg(a.attname::text ORDER BY a.attnum),
+    array_agg(format_type(a.atttypid, a.atttypmod) ORDER BY a.attnum),
+    coalesce((
+        SELECT array_agg(pk.attname::text ORDER BY k.idx)
+        FROM pg_index i
+        CROSS JOIN unnest(i.indkey) WITH ORDINALITY k(attnum, idx)
+        JOIN pg_attribute pk
+            ON pk.attrelid = i.indrelid AND pk.attnum = k.attnum
+        WHERE k.idx <= i.indnkeyatts AND i.indexrelid = (
+            SELECT u.indexrelid
+            FROM pg_index u
+            CROSS JOIN LATERAL (
+                SELECT (u.indkey::int2[])[0:u.indnkeyatts - 1] AS attnums
+            ) uk
+            WHERE u.indrelid = c.oid AND u.indisunique AND u.indisvalid
+                AND u.indpred IS NULL AND NOT 0 = ANY(uk.attnums)
+                AND NOT EXISTS (
+                    SELECT FROM pg_attribute ua
+                    WHERE ua.attrelid = u.indrelid
+                        AND ua.attnum = ANY(uk.attnums) AND NOT ua.attnotnull)
+            ORDER BY
+                u.indisprimary DESC,
+                u.indnkeyatts,
+                (SELECT sum(CASE WHEN t.typlen > 0 THEN t.typlen ELSE 64 END)
+                 FROM pg_attribute ua
+                 JOIN pg_type t ON t.oid = ua.atttypid
+                 WHERE ua.attrelid = u.indrelid
+                    AND ua.attnum = ANY(uk.attnums)),
+                u.indexrelid
+            LIMIT 1)
+    ), '{{}}'),
+    c.reltuples::bigint,
+    c.relpages::float8 * current_setting('block_size')::int
+        / nullif(c.reltuples, 0),
+    NOT bool_or(b.oid >= 16384
+                AND (b.typtype IN ('c', 'd') OR b.typcategory = 'A'))
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+JOIN pg_attribute a
+    ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+JOIN pg_type t ON t.oid = a.atttypid
+JOIN pg_type b
+    ON b.oid = CASE WHEN t.typtype = 'd' THEN t.typbasetype ELSE t.oid END
+WHERE c.relkind IN ('r', 'p') AND {SCHEMA_FILTER}
+GROUP BY n.oid, c.oid;
+"""
+
+GET_HISTOGRAM_SQL = """
+SELECT unnest(histogram_bounds::text::{coltype}[]) FROM pg_stats
+WHERE schemaname = :schema AND tablename = :table AND attname = :column;
+"""
+
+# the snapshot every session of a database starts its transactions from with
+# --consistent, and how far the WAL went when it was taken
+CURRENT_LSN = """
+    CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn()
+        ELSE pg_current_wal_lsn() END"""
+
+EXPORT_SNAPSHOT_SQL = f"SELECT pg_export_snapshot(), {CURRENT_LSN};"
+
+# how long to wait for a replica to replay the WAL up to a given point
+REPLAY_TIMEOUT = 300
+
+REPLAYED_SQL = "SELECT pg_last_wal_replay_lsn() >= CAST(:lsn AS pg_lsn);"
+
+# an order-independent digest of rows, for tables without a key and for
+# --strategy=ctid, made of two 64 bit hashes summed over all rows (which,
+# unlike xor, counts duplicate rows). It takes a single scan and no sort.
+MULTISET_DIGEST_SQL = """
+SELECT
+    count(*),
+    sum(hashtextextended((t.*)::text, 0)),
+    sum(hashtextextended((t.*)::text, 1))
+FROM {relation} t
+WHERE {where_expr};
+"""
+
+# tells a database apart from others for --incremental: pg_basebackup
+# copies and replicas share the system identifier of their primary
+DATABASE_IDENTITY_SQL = """
+SELECT system_identifier || '/' || current_database()
+FROM pg_control_system();
+"""
+
+GET_BLOCKS_SQL = """
+SELECT
+    pg_relation_size(CAST(:relation AS regclass)),
+    current_setting('block_size')::int;
+"""
+
+STRATEGIES = ('keyset', 'ctid')
+
+# the first server_version_num with TID range scans. Before, a ctid range
+# is a filter on a scan of the whole table, once per range.
+TID_RANGE_SCAN_VERSION = 140000
+
+# --rows fetches rows this many at a time
+ROWS_FETCH_SIZE = 1000
+
+# types of primary key columns ordered with COLLATE "C" by --rows
+COLLATABLE_TYPES = ('text', 'character', 'character varying')
+
+# types of primary key columns whose values are ordered by python the same
+# way as by ORDER BY, which --rows needs to merge both sides. bytea values
+# are compared as bytes, see row_key.
+MERGEABLE_TYPES = COLLATABLE_TYPES + (
+    'smallint', 'integer', 'bigint', 'boolean', 'uuid', 'bytea', 'date',
+    'timestamp without time zone', 'timestamp with time zone')
+
+# --chunk-size=auto starts from the number of rows that fit in
+# AUTO_CHUNK_BYTES, then aims at chunks taking AUTO_CHUNK_SECONDS.
+AUTO_CHUNK_SECONDS = 0.5
+AUTO_CHUNK_BYTES = 32 * 1024 * 1024
+AUTO_CHUNK_SIZE_START = 10000
+AUTO_CHUNK_SIZE_MIN = 1000
+AUTO_CHUNK_SIZE_MAX = 1000000
+
+# aggregates hashing the rows "t" of a chunk. md5 builds an array of every
+# row digest first; the others fold the digests as they go, sum and xor
+# (PostgreSQL 11+ and 14+) do it in constant memory and ignore row order.
+HASH_ALGORITHMS = {
+    'md5': "md5(array_agg(md5((t.*)::varchar))::varchar)",
+    'md5-string': "md5(string_agg(md5((t.*)::varchar), ''))",
+    'sum': "sum(hashtextextended((t.*)::varchar, 0))::varchar",
+    'xor': "bit_xor(hashtextextended((t.*)::varchar, 0))::varchar",
+}
+
+
+def make_session(connection_string, pool_size=5, statement_timeout='0',
+                 lock_timeout='0', isolation_level=None):
+    # pgdatadiff only ever reads, which also makes it safe to point at
+    # hot standby replicas. Every chunk is a single statement, so
+    # statement_timeout bounds the time spent on a chunk.
+    # the pool never grows past pool_size, connections are checked with a
+    # ping before being handed out and kept open between tables.
+    engine = create_engine(
+        connection_string, echo=False, convert_unicode=True,
+        poolclass=StatsPool, pool_size=pool_size, max_overflow=0,
+        pool_timeout=3600, pool_pre_ping=True, isolation_level=isolation_level,
+        connect_args={'options': ' '.join([
+            '-c default_transaction_read_only=on',
+            f'-c statement_timeout={statement_timeout}',
+            f'-c lock_timeout={lock_timeout}'])})
     Session = sessionmaker(bind=engine)
     return Session(), engine
 
 
+def export_snapshot(connection_string):
+    # the snapshot is only importable while the transaction exporting it is
+    # open, so it gets a connection of its own, outside of the pool, kept
+    # until the end of the run
+    engine = create_engine(
+        connection_string, poolclass=NullPool,
+        isolation_level='REPEATABLE READ',
+        connect_args={'options': '-c default_transaction_read_only=on'})
+    connection = engine.connect()
+    connection.begin()
+    snapshot, lsn = connection.execute(EXPORT_SNAPSHOT_SQL).fetchone()
+    return connection, snapshot, lsn
+
+
+def use_snapshot(session, snapshot):
+    @event.listens_for(session, 'after_begin')
+    def set_snapshot(session, transaction, connection):
+        # the ping on checkout already started a transaction, in which
+        # the snapshot can no longer be set
+        connection.connection.rollback()
+        connection.execute(f"SET TRANSACTION SNAPSHOT '{snapshot}';")
+
+
+def wait_for_replay(replayed, timeout=REPLAY_TIMEOUT):
+    # polls a replica until replayed() tells it replayed far enough, returns
+    # False when it did not within timeout seconds
+    deadline = time.monotonic() + timeout
+    while not replayed():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.1)
+    return True
+
+
 class DBDiff(object):
 
-    def __init__(self, firstdb, seconddb, chunk_size=100000, count_only=False):
-        firstsession, firstengine = make_session(firstdb)
-        secondsession, secondengine = make_session(seconddb)
+    def __init__(self, firstdb, seconddb, chunk_size=100000, count_only=False,
+                 count_estimate=False, jobs=1, partitions=1, bisect=False,
+                 leaf_size=100, rows=False, copy=False,
+                 keep_going=False, hash_algo='md5', cache_file=None,
+                 schemas=None, all_schemas=False, max_connections_first=None,
+                 max_connections_second=None, statement_timeout='0',
+                 lock_timeout='0', checkpoint_file=None, resume=False,
+                 consistent=False, align_lsn=False, wait_for_replica=False,
+                 repair_dir=None, batch_size=1000, strategy='keyset'):
+        self.jobs = int(jobs)
+        self.partitions = int(partitions)
+        # one connection per side for every worker, unless capped. Workers
+        # beyond the cap wait for a connection to be released.
+        pool_size = self.jobs * self.partitions + 1
+        isolation_level = 'REPEATABLE READ' if consistent else None
+        firstsession, firstengine = make_session(
+            firstdb, int(max_connections_first or pool_size),
+            statement_timeout, lock_timeout, isolation_level)
+        secondsession, secondengine = make_session(
+            seconddb, int(max_connections_second or pool_size),
+            statement_timeout, lock_timeout, isolation_level)
         self.firstsession = firstsession
         self.firstengine = firstengine
         self.secondsession = secondsession
         self.secondengine = secondengine
-        self.firstmeta = MetaData(bind=firstengine)
-        self.secondmeta = MetaData(bind=secondengine)
-        self.firstinspector = inspect(firstengine)
-        self.secondinspector = inspect(secondengine)
-        self.chunk_size = int(chunk_size)
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        for future in [
+                self.executor.submit(prewarm, engine, engine.pool.size())
+                for engine in (firstengine, secondengine)]:
+            future.result()
+        (self.firstrecovery, firstversion), \
+            (self.secondrecovery, secondversion) = (
+                result.fetchone() for result in self.execute_both(
+                    "SELECT pg_is_in_recovery(), "
+                    "current_setting('server_version_num')::int;"))
+        if strategy == 'ctid' and \
+                min(firstversion, secondversion) < TID_RANGE_SCAN_VERSION:
+            self.release()
+            raise ValueError("--strategy=ctid needs PostgreSQL 14 or later "
+                             "on both databases")
+        self.wait_for_replica = wait_for_replica and self.secondrecovery
+        if wait_for_replica and not self.secondrecovery:
+            print('Second database is not a replica, '
+                  'not waiting for it to catch up.')
+        self.snapshots = None
+        if consistent:
+            self.snapshots = self.export_snapshots(
+                firstdb, seconddb, align_lsn)
+            self.use_snapshots()
+        self.schemas = list(schemas or ['public'])
+        self.all_schemas = all_schemas
+        self.firstcatalog, self.secondcatalog = (
+            {f'{row[0]}.{row[1]}': TableInfo(*row) for row in result}
+            for result in self.execute_both(GET_CATALOG_SQL, {
+                'schemas': self.schemas, 'all_schemas': self.all_schemas}))
+        # None means the chunk size is picked per table, see
+        # initial_chunk_size and next_chunk_size.
+        self.chunk_size = None if chunk_size == 'auto' else int(chunk_size)
         self.count_only = count_only
+        self.count_estimate = count_estimate
+        self.bisect = bisect
+        # the rows to repair are those found by --rows, or --bisect
+        self.repair = Repair(repair_dir, batch_size) if repair_dir else None
+        self.rows = rows or bool(self.repair and not bisect)
+        self.copy = copy
+        self.strategy = strategy
+        # a repair covers every different chunk, not only the first one
+        self.keep_going = keep_going or bool(self.repair)
+        self.hash_expr = HASH_ALGORITHMS[hash_algo]
+        self.cache = None
+        if cache_file:
+            firstresult, secondresult = self.execute_both(
+                DATABASE_IDENTITY_SQL)
+            self.cache = ChunkCache(
+                cache_file, f"{firstresult.scalar()} {secondresult.scalar()}")
+        self.checkpoint = Checkpoint(checkpoint_file, resume) \
+            if checkpoint_file else None
+        self.leaf_size = int(leaf_size)
+        self.release()
 
-    def diff_table_data(self, tablename):
+    def execute_both(self, statement, params=None, context=None):
+        # each side is retried on its own: only the side that failed runs
+        # again. context tells which table and chunk a retry was for.
+        suffix = f' ({context})' if context else ''
+        sessions = (self.firstsession, self.secondsession)
+        names = ('first database' + suffix, 'second database' + suffix)
+        results = [None, None]
+        tries = [0, 0]
+        while True:
+            errors = {}
+            # checked out in order, see checkout
+            for side, session in enumerate(sessions):
+                try:
+                    session.connection()
+                except Exception as ex:
+                    errors[side] = ex
+                    break
+            if not errors:
+                futures = {
+                    side: self.executor.submit(
+                        sessions[side].execute, statement, params)
+                    for side in (0, 1) if results[side] is None}
+                wait(futures.values())
+                for side, future in futures.items():
+                    try:
+                        results[side] = future.result()
+                    except Exception as ex:
+                        errors[side] = ex
+            if not errors:
+                return tuple(results)
+            # both are released, to be checked out again in order. The
+            # result of the side that succeeded stays readable.
+            self.release()
+            delays = []
+            for side, ex in errors.items():
+                delays.append(retry_delay(ex, names[side], tries[side]))
+                tries[side] += 1
+            time.sleep(max(delays))
+
+    def checkout(self):
+        # every worker takes a connection of the first pool before one of
+        # the second, so that with capped pools no worker waits for the
+        # second while holding the first one another worker waits for
+        self.firstsession.connection()
+        self.secondsession.connection()
+
+    def retry_both(self, fn, name):
+        # runs fn with the connections of both sides checked out. After an
+        # error both are released, to be checked out again in order.
+        def run():
+            self.checkout()
+            try:
+                return fn()
+            except Exception:
+                self.release()
+                raise
+
+        return retry(run, name)
+
+    def spawn(self):
+        worker = copy.copy(self)
+        worker.firstsession = sessionmaker(bind=self.firstengine)()
+        worker.secondsession = sessionmaker(bind=self.secondengine)()
+        worker.executor = ThreadPoolExecutor(max_workers=2)
+        if self.snapshots:
+            worker.use_snapshots()
+        return worker
+
+    def export_snapshots(self, firstdb, seconddb, align_lsn=False):
+        # with align_lsn the second database is taken for a replica of the
+        # first one, and its snapshot is only taken once it replayed
+        # everything the snapshot of the first one sees.
+        firstconnection, firstsnapshot, lsn = export_snapshot(firstdb)
+        if align_lsn:
+            self.release()
+            if not self.secondrecovery:
+                print('Second database is not a replica, '
+                      'not aligning snapshots.')
+            elif not wait_for_replay(lambda: self.replayed(lsn)):
+                print(f'Second database did not replay up to {lsn} '
+                      f'within {REPLAY_TIMEOUT} secs, '
+                      f'not aligning snapshots.')
+            self.release()
+        secondconnection, secondsnapshot, _ = export_snapshot(seconddb)
+        return (firstconnection, firstsnapshot), \
+            (secondconnection, secondsnapshot)
+
+    def wait_for_second(self):
+        lsn = self.retry_both(lambda: self.firstsession.execute(
+            f"SELECT {CURRENT_LSN};").scalar(), 'first database')
+        if not wait_for_replay(lambda: self.replayed(lsn)):
+            print(f'Second database did not replay up to {lsn} '
+                  f'within {REPLAY_TIMEOUT} secs.')
+
+    def replayed(self, lsn):
+        return self.retry_both(lambda: self.secondsession.execute(
+            REPLAYED_SQL, {'lsn': lsn}).scalar(), 'second database')
+
+    def use_snapshots(self):
+        (_, firstsnapshot), (_, secondsnapshot) = self.snapshots
+        self.release()
+        use_snapshot(self.firstsession, firstsnapshot)
+        use_snapshot(self.secondsession, secondsnapshot)
+
+    def release(self):
+        # ends the read-only transactions, which hands the connections back
+        # to the pools for other workers to use
+        self.firstsession.rollback()
+        self.secondsession.rollback()
+
+    def close(self):
+        self.firstsession.close()
+        self.secondsession.close()
+        self.executor.shutdown()
+
+    def map_workers(self, fn, items, max_workers=None):
+        # every thread gets its own worker, i.e. its own pair of sessions;
+        # results are yielded in the order of items. The workers are closed
+        # once the results are all read or the generator is closed.
+        local = threading.local()
+        workers = []
+
+        def run(item):
+            worker = getattr(local, 'worker', None)
+            if worker is None:
+                worker = local.worker = self.spawn()
+                workers.append(worker)
+            try:
+                return fn(worker, item)
+            finally:
+                worker.release()
+
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers or self.jobs) \
+                    as executor:
+                yield from executor.map(run, items)
+        finally:
+            for worker in workers:
+                worker.close()
+
+    def diff_checkpointed_table(self, tablename):
+        # tables done before an interrupted run stopped are not compared
+        # again
+        done = self.checkpoint and self.checkpoint.get_table(tablename)
+        if done:
+            return done[0], f"{done[1]} (from checkpoint)"
         try:
-            if self.count_only is True:
-                firsttable = Table(tablename, self.firstmeta, autoload=True)
-                firstquery = self.firstsession.query(
-                    firsttable)
-                secondtable = Table(tablename, self.secondmeta, autoload=True)
-                secondquery = self.secondsession.query(
-                    secondtable)
-                first_table_count = firstquery.count()
-                if first_table_count != secondquery.count():
-                    return False, f"counts are different" \
-                        f" {first_table_count} != {secondquery.count()}"
-                if first_table_count == 0:
-                    return None, "tables are empty"
-                return True, "Counts are the same"
-        except NoSuchTableError:
+            result, message = self.diff_table_data(tablename)
+        except (OperationalError, DatabaseError) as ex:
+            # out of retries: the table fails but the run carries on, and a
+            # resumed run compares it again
+            self.release()
+            return False, f"gave up: {getattr(ex, 'orig', ex)}"
+        if self.repair:
+            script = self.repair.write(
+                self.firstsession.connection().connection, tablename,
+                self.firstcatalog[tablename])
+            if script:
+                message += f" Repair script: {script}"
+        if self.checkpoint:
+            self.checkpoint.put_table(tablename, result, message)
+        return result, message
+
+    def diff_table_data(self, tablename):
+        if tablename not in self.secondcatalog:
             return False, "table is missing"
+        firsttable = self.firstcatalog[tablename]
+        secondtable = self.secondcatalog[tablename]
+
+        if self.count_estimate:
+            return diff_estimates(firsttable, secondtable)
 
-        pks = self.firstinspector.get_pk_constraint(tablename)[
-                            'constrained_columns']
+        if self.count_only is True:
+            firstresult, secondresult = self.execute_both(
+                f"SELECT count(*) FROM {firsttable.qualified};")
+            return compare_counts(firstresult.scalar(), secondresult.scalar())
+
+        if self.strategy == 'ctid':
+            return self.diff_table_blocks(tablename)
+
+        pks = firsttable.pks
         if not pks:
-            return None, "no primary key(s) on this table." \
-                            " Comparison is not possible."
+            firstresult, secondresult = self.execute_both(
+                MULTISET_DIGEST_SQL.format(
+                    relation=firsttable.qualified, where_expr='true'))
+            result, message = compare_digests(firstresult.fetchone(),
+                                              secondresult.fetchone())
+            return result, f"no unique key; {message}"
 
-        next_offset_select_expr = ', '.join(
-            ('last({pk})'.format(pk=pk) for pk in pks)
-        )
-        order_expr = ', '.join(pks)
-        offset_expr = ' AND '.join('{pk} >= :{pk}'.format(pk=pk) for pk in pks)
-        offset_expr += ' AND (' \
-            + ' OR '.join('{pk} <> :{pk}'.format(pk=pk) for pk in pks) \
-            + ')'
+        if self.cache:
+            self.cache.open_table(tablename, self.get_watermark(tablename))
+
+        if self.partitions > 1:
+            ranges = self.checkpoint and self.checkpoint.get_ranges(tablename)
+            if not ranges:
+                ranges = self.get_partition_ranges(tablename, pks[0])
+                if self.checkpoint:
+                    self.checkpoint.put_ranges(tablename, ranges)
+        else:
+            ranges = [(None, None)]
+        if len(ranges) == 1:
+            return self.diff_table_range(tablename, pks, *ranges[0])
+
+        self.release()
+        results = self.map_workers(
+            lambda worker, bounds: worker.diff_table_range(
+                tablename, pks, *bounds),
+            ranges, max_workers=len(ranges))
+        return combine_ranges(ranges, list(results))
+
+    def diff_table_blocks(self, tablename):
+        # --strategy=ctid: hashes ranges of heap blocks, read with TID range
+        # scans (PostgreSQL 14+), in parallel. Only meaningful when both
+        # databases have the same heap layout, i.e. physical replicas.
+        table = self.firstcatalog[tablename]
+        # a resumed table keeps the ranges it was started with
+        ranges = self.checkpoint and self.checkpoint.get_ranges(tablename)
+        if not ranges:
+            ranges = self.get_block_ranges(table)
+            if self.checkpoint:
+                self.checkpoint.put_ranges(tablename, ranges)
+
+        self.release()
+        results = list(self.map_workers(
+            lambda worker, bounds: worker.diff_checkpointed_blocks(
+                tablename, *bounds),
+            ranges, max_workers=self.partitions))
+        failures = [
+            f"blocks [{lower}, {'end' if upper is None else upper}): {message}"
+            for (lower, upper), (result, message) in zip(ranges, results)
+            if result is False
+        ]
+        if failures:
+            return False, '; '.join(failures)
+        if all(result is None for result, _ in results):
+            return None, "tables are empty"
+        return True, f"data is identical ({len(ranges)} block ranges)."
+
+    def get_block_ranges(self, table):
+        (firstsize, block_size), (secondsize, _) = (
+            result.fetchone() for result in self.execute_both(
+                GET_BLOCKS_SQL, {'relation': table.qualified}))
+        blocks = max(firstsize, secondsize) // block_size
+        if self.chunk_size and table.width:
+            step = max(1, int(self.chunk_size * table.width // block_size))
+        else:
+            step = AUTO_CHUNK_BYTES // block_size
+        # the last range is open, for blocks added since the sizes were read
+        bounds = list(range(step, blocks, step))
+        return list(zip([0] + bounds, bounds + [None]))
+
+    def diff_checkpointed_blocks(self, tablename, lower, upper):
+        done = self.checkpoint and self.checkpoint.get_progress(
+            tablename, lower, upper)
+        if done:
+            return tuple(done)
+        result = self.diff_blocks(self.firstcatalog[tablename], lower, upper)
+        if self.checkpoint:
+            self.checkpoint.put_progress(tablename, lower, upper, result)
+        return result
+
+    def diff_blocks(self, table, lower, upper):
+        where_expr = f"t.ctid >= '({lower},0)'::tid"
+        if upper is not None:
+            where_expr += f" AND t.ctid < '({upper},0)'::tid"
+        for recheck in (False, True):
+            if recheck:
+                # hashed again once the second database caught up, as
+                # diff_table_range does
+                self.wait_for_second()
+            firstresult, secondresult = self.execute_both(
+                MULTISET_DIGEST_SQL.format(
+                    relation=table.qualified, where_expr=where_expr),
+                context=f"{table.qualified} blocks from {lower}")
+            result, message = compare_digests(firstresult.fetchone(),
+                                              secondresult.fetchone())
+            if result is not False or not self.wait_for_replica:
+                break
+        return result, message
+
+    def diff_table_range(self, tablename, pks, lower=None, upper=None):
+        table = self.firstcatalog[tablename]
+        scan = ChunkScan(table.qualified, pks, self.hash_expr,
+                         self.chunk_size or initial_chunk_size(table),
+                         lower, upper, auto=self.chunk_size is None)
+        range_expr, range_params = scan.range_expr, scan.range_params
+        rechecked = 0
+
+        progress = self.checkpoint and self.checkpoint.get_progress(
+            tablename, lower, upper)
+        if progress:
+            scan.restore(progress)
+
+        def save_progress():
+            if self.checkpoint:
+                self.checkpoint.put_progress(
+                    tablename, lower, upper, scan.progress())
+
+        while not scan.done:
+            cached = self.cache and self.cache.get(
+                tablename, (lower, upper), scan.last_key)
+            if cached:
+                upper_key, count = cached
+                if self.count_range(tablename, pks, scan.last_key, upper_key,
+                                    range_expr, range_params) == \
+                        (count, count):
+                    scan.skip(count, upper_key)
+                    save_progress()
+                    continue
+
+            statement, params = scan.next_query()
+            for recheck in (False, True):
+                if recheck:
+                    # the second database may only be lagging behind, so
+                    # the chunk is hashed again once it replayed everything
+                    # the first one has
+                    self.wait_for_second()
+                started = time.monotonic()
+                try:
+                    # retries start over from last_key, not from the
+                    # beginning
+                    firstresult, secondresult = self.execute_both(
+                        statement, params,
+                        f"{tablename} after key {format_key(scan.last_key)}")
+                except OperationalError as ex:
+                    return False, scan.gave_up(ex.orig)
+                if not recheck:
+                    scan.timed(time.monotonic() - started)
+
+                if firstresult.rowcount != secondresult.rowcount:
+                    return False, f"row count mismatch at row " \
+                                  f"{scan.position}; query params: {params}"
+
+                first = read_chunk(firstresult.fetchone())
+                second = read_chunk(secondresult.fetchone())
+                if not self.wait_for_replica or first == second:
+                    rechecked += recheck
+                    break
 
-        SQL_TEMPLATE_HASH = f"""
+            if (self.bisect or self.rows or self.keep_going) and \
+                    first != second:
+                upper_key = scan.upper_key(first, second)
+                if self.bisect or self.rows:
+                    if self.bisect:
+                        diffs = self.bisect_range(
+                            tablename, pks, scan.last_key, upper_key,
+                            range_expr, range_params)
+                    else:
+                        diffs = list(self.diff_rows(
+                            tablename, pks, scan.last_key, upper_key,
+                            range_expr, range_params))
+                    if self.repair:
+                        self.repair.add(tablename, diffs)
+                    description = describe_row_diffs(diffs, table.columns)
+                else:
+                    description = describe_counts(first, second)
+                if not self.keep_going:
+                    return False, f"data is different after row " \
+                                  f"{scan.position}; {description}"
+                scan.differ(first, second, upper_key, description)
+                save_progress()
+                continue
+
+            failure = scan.check(first, second, params)
+            if failure:
+                return False, failure
+            if self.cache and first.count:
+                self.cache.put(tablename, (lower, upper), scan.last_key,
+                               first.last_key, first.hash, first.count)
+            scan.advance(first)
+            save_progress()
+
+        notes = []
+        if self.cache:
+            notes.append(f"{scan.skipped} chunks unchanged")
+        if rechecked:
+            notes.append(f"{rechecked} chunks identical once caught up")
+        return scan.result(notes)
+
+    def get_watermark(self, tablename):
+        # changes when rows are updated or deleted, or the table rewritten.
+        # The statistics counters are flushed asynchronously, up to a second
+        # or so after the transactions they count commit.
+        GET_WATERMARK_SQL = """
+        SELECT c.relfilenode || ':' || coalesce(s.n_tup_upd + s.n_tup_del, 0)
+        FROM pg_class c
+        LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+        WHERE c.oid = CAST(:relation AS regclass);
+        """
+        firstresult, secondresult = self.execute_both(
+            GET_WATERMARK_SQL,
+            {'relation': self.firstcatalog[tablename].qualified})
+        return f"{firstresult.scalar()}/{secondresult.scalar()}"
+
+    def count_range(self, tablename, pks, lower_key, upper_key,
+                    range_expr='', range_params=None):
+        relation = self.firstcatalog[tablename].qualified
+        where_expr, params = key_range_filter(
+            pks, lower_key, upper_key, range_expr, range_params)
+        firstresult, secondresult = self.execute_both(
+            f"SELECT count(*) FROM {relation} WHERE {where_expr};", params)
+        return firstresult.scalar(), secondresult.scalar()
+
+    def bisect_range(self, tablename, pks, lower_key, upper_key,
+                     range_expr='', range_params=None):
+        # compare the rows in (lower_key, upper_key] by hashing both halves
+        # of the range until they are small enough to compare row by row.
+        relation = self.firstcatalog[tablename].qualified
+        order_expr = ', '.join(map(quote_ident, pks))
+        where_expr, params = key_range_filter(
+            pks, lower_key, upper_key, range_expr, range_params)
+
+        SQL_TEMPLATE_RANGE_HASH = f"""
         SELECT
-            md5(array_agg(md5((t.*)::varchar))::varchar) as hash,
-            count(*) as count,
-            {next_offset_select_expr}
+            {self.hash_expr} as hash,
+            count(*) as count
         FROM
             (
-                SELECT * from {tablename}
-                WHERE NOT :has_offset OR ({offset_expr})
+                SELECT * from {relation}
+                WHERE {where_expr}
                 ORDER BY {order_expr}
-                LIMIT {self.chunk_size}
             ) t;
         """
+        firstresult, secondresult = self.execute_both(
+            SQL_TEMPLATE_RANGE_HASH, params)
+        (firsthash, firstcount) = firstresult.fetchone()
+        (secondhash, secondcount) = secondresult.fetchone()
+        if (firsthash, firstcount) == (secondhash, secondcount):
+            return []
 
-        done = False
-        position = 0
-        params = {pk: None for pk in pks}
-
-        while not done:
-            params['has_offset'] = any(params.values())
-            # print('table', tablename, ': position', position, '; params', params)
-            firstresult = retry(lambda: self.firstsession.execute(
-                SQL_TEMPLATE_HASH,
-                params))
-            secondresult = retry(lambda: self.secondsession.execute(
-                SQL_TEMPLATE_HASH,
-                params))
-
-            if firstresult.rowcount != secondresult.rowcount:
-                return False, f"row count mismatch at row {position}; " \
-                              f"query params: {params}"
-
-            (firsthash, firstcount, *firstpks) = firstresult.fetchone()
-            (secondhash, secondcount, *secondpks) = secondresult.fetchone()
-
-            if firsthash != secondhash:
-                return False, f"data hash are different at row {position}; " \
-                              f"query params: {params}; " \
-                              f"first: {firsthash}; second: {secondhash}"
-
-            if firstcount != secondcount:
-                return False, f"row count are different at row {position}; " \
-                              f"query params: {params}; " \
-                              f"first: {firstcount}; second: {secondcount}"
-
-            if firstpks != secondpks:
-                return False, f"data pks are different  at row {position};" \
-                              f"query params: {params}; " \
-                              f"first: {firstpks}; second: {secondpks}"
-
-            position += self.chunk_size
-            for idx, pk in enumerate(pks):
-                params[pk] = firstpks[idx]
-
-            # we're done when we have less rows than the limit
-            done = firstcount < self.chunk_size
+        if max(firstcount, secondcount) <= self.leaf_size:
+            SQL_TEMPLATE_ROW_HASHES = f"""
+            SELECT {order_expr}, md5((t.*)::varchar)
+            FROM {relation} t
+            WHERE {where_expr}
+            ORDER BY {order_expr};
+            """
+            firstresult, secondresult = self.execute_both(
+                SQL_TEMPLATE_ROW_HASHES, params)
+            return compare_row_hashes(
+                {row_key(row[:-1]): row[-1] for row in firstresult},
+                {row_key(row[:-1]): row[-1] for row in secondresult})
 
-        return True, "data is identical."
+        # split on the middle row of the side that has the most rows, which
+        # leaves fewer rows on both sides of each half, down to a single one
+        SQL_TEMPLATE_MIDDLE_KEY = f"""
+        SELECT {order_expr} from {relation}
+        WHERE {where_expr}
+        ORDER BY {order_expr}
+        OFFSET :middle LIMIT 1;
+        """
+        if firstcount >= secondcount:
+            session, name, count = \
+                self.firstsession, 'first database', firstcount
+        else:
+            session, name, count = \
+                self.secondsession, 'second database', secondcount
+        middle_key = list(self.retry_both(lambda: session.execute(
+            SQL_TEMPLATE_MIDDLE_KEY, dict(params, middle=(count - 1) // 2))
+            .fetchone(), name))
 
-    def get_all_sequences(self):
-        GET_SEQUENCES_SQL = """SELECT c.relname FROM
-        pg_class c WHERE c.relkind = 'S';"""
-        return [x[0] for x in
-                self.firstsession.execute(GET_SEQUENCES_SQL).fetchall()]
+        return self.bisect_range(
+            tablename, pks, lower_key, middle_key, range_expr,
+            range_params
+        ) + self.bisect_range(
+            tablename, pks, middle_key, upper_key, range_expr,
+            range_params
+        )
 
-    def diff_sequence(self, seq_name):
-        GET_SEQUENCES_VALUE_SQL = f"SELECT last_value FROM {seq_name};"
+    def diff_rows(self, tablename, pks, lower_key, upper_key,
+                  range_expr='', range_params=None):
+        # the missing, extra and changed rows in (lower_key, upper_key],
+        # merged from both sides in primary key order, without holding
+        # more than ROWS_FETCH_SIZE rows of each side in memory.
+        table = self.firstcatalog[tablename]
+        keytypes = [base_type(table.types[table.columns.index(pk)])
+                    for pk in pks]
+        where_expr, params = key_range_filter(
+            pks, lower_key, upper_key, range_expr, range_params)
+        order_expr = ', '.join(
+            order_column(pk, table.types[table.columns.index(pk)])
+            for pk in pks)
+        SQL_TEMPLATE_ROWS = f"""
+        SELECT {', '.join(map(quote_ident, pks))}, t.*
+        FROM {table.qualified} t
+        WHERE {where_expr}
+        ORDER BY {order_expr}
+        """
 
-        try:
-            firstvalue = retry(
-                lambda: self.firstsession.execute(GET_SEQUENCES_VALUE_SQL)
-                .fetchone()[0]
-            )
-            secondvalue = retry(
-                lambda: self.secondsession.execute(GET_SEQUENCES_VALUE_SQL)
-                .fetchone()[0]
-            )
-        except ProgrammingError:
-            self.firstsession.rollback()
-            self.secondsession.rollback()
-
-            return False, "sequence doesnt exist in second database."
-        if firstvalue < secondvalue:
-            return None, f"first sequence is less than" \
-                         f" the second({firstvalue} vs {secondvalue})."
-        if firstvalue > secondvalue:
-            return False, f"first sequence is greater than" \
-                          f" the second({firstvalue} vs {secondvalue})."
-        return True, f"sequences are identical- ({firstvalue})."
+        # with binary COPY, values are compared as sent by the server, which
+        # takes keys that can be decoded, the same column types on both
+        # sides and no OIDs of user types in the values
+        secondtable = self.secondcatalog[tablename]
+        decoders = self.copy and table.types == secondtable.types and \
+            table.portable and secondtable.portable and \
+            key_decoders(table, pks)
+        sessions = (self.firstsession, self.secondsession)
+        if not all(keytype in MERGEABLE_TYPES for keytype in keytypes):
+            # keys python orders differently, e.g. enums or inet, are
+            # matched by value instead, with both sides of the chunk in
+            # memory, as --bisect does
+            firstrows, secondrows = (
+                {row_key(row[:len(pks)]): tuple(row[len(pks):])
+                 for row in result}
+                for result in self.execute_both(SQL_TEMPLATE_ROWS, params))
+            for diff in compare_row_hashes(firstrows, secondrows):
+                yield diff._replace(first=firstrows.get(diff.key),
+                                    second=secondrows.get(diff.key))
+            return
+
+        if decoders:
+            connections = self.retry_both(
+                lambda: [session.connection().connection
+                         for session in sessions], 'first or second database')
+            streams = [
+                copy_rows(connection, SQL_TEMPLATE_ROWS, params, decoders)
+                for connection in connections]
+            try:
+                for diff in merge_rows(*streams):
+                    yield diff._replace(
+                        first=diff.first and split_values(diff.first),
+                        second=diff.second and split_values(diff.second))
+            finally:
+                # stops the COPY of a side that was not read to the end
+                for stream in streams:
+                    stream.close()
+            return
+
+        # read through server-side cursors
+        results = self.retry_both(lambda: [
+            session.connection().execution_options(
+                stream_results=True, max_row_buffer=ROWS_FETCH_SIZE
+            ).execute(text(SQL_TEMPLATE_ROWS), params)
+            for session in sessions], 'first or second database')
+        yield from merge_rows(
+            *(stream_rows(result, len(pks)) for result in results))
+
+    def get_partition_ranges(self, tablename, column):
+        # split the values of column into self.partitions ranges, using the
+        # planner's histogram if the table was analyzed, min/max otherwise.
+        table = self.firstcatalog[tablename]
+        coltype = table.types[table.columns.index(column)]
+        values = [x[0] for x in self.retry_both(
+            lambda: self.firstsession.execute(
+                GET_HISTOGRAM_SQL.format(coltype=coltype),
+                {'schema': table.schema, 'table': table.name,
+                 'column': column}).fetchall(),
+            f'first database ({tablename} histogram)')]
+
+        if values:
+            bounds = partition_bounds(values, self.partitions)
+        else:
+            low, high = self.retry_both(
+                lambda: self.firstsession.execute(
+                    f"SELECT min({quote_ident(column)}), "
+                    f"max({quote_ident(column)}) FROM {table.qualified};"
+                ).fetchone(),
+                f'first database ({tablename} min and max)')
+            if not isinstance(low, int) or not isinstance(high, int):
+                return [(None, None)]
+            bounds = [low + (high - low) * i // self.partitions
+                      for i in range(1, self.partitions)]
+        return split_ranges(bounds)
+
+    def get_all_sequences(self, session=None):
+        # maps schema.sequence to the quoted name to use in SQL and whether
+        # the user may read it
+        GET_SEQUENCES_SQL = f"""
+        SELECT
+            n.nspname || '.' || c.relname,
+            format('%I.%I', n.nspname, c.relname),
+            has_sequence_privilege(c.oid, 'SELECT')
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE c.relkind = 'S' AND {SCHEMA_FILTER};
+        """
+        session = session or self.firstsession
+        return {
+            sequence: (qualified, readable)
+            for sequence, qualified, readable in session.execute(
+                GET_SEQUENCES_SQL, {
+                    'schemas': self.schemas,
+                    'all_schemas': self.all_schemas
+                }).fetchall()
+        }
+
+    def get_sequence_values(self, session, name):
+        # reads every sequence at once, pg_sequences would hide is_called.
+        # The sequences the user may not read map to None.
+        sequences = retry(
+            lambda: self.get_all_sequences(session), name, session)
+        values = {sequence: None for sequence, (_, readable)
+                  in sequences.items() if not readable}
+        sequences = {sequence: qualified for sequence, (qualified, readable)
+                     in sequences.items() if readable}
+        if not sequences:
+            return values
+        GET_SEQUENCE_VALUES_SQL = '\nUNION ALL\n'.join(
+            f"SELECT :name_{idx}, last_value, is_called FROM {qualified}"
+            for idx, qualified in enumerate(sequences.values()))
+        params = {f'name_{idx}': sequence
+                  for idx, sequence in enumerate(sequences)}
+        return dict(values, **{
+            sequence: (last_value, is_called)
+            for sequence, last_value, is_called in retry(
+                lambda: session.execute(
+                    GET_SEQUENCE_VALUES_SQL, params).fetchall(), name,
+                session)
+        })
 
     def diff_all_sequences(self):
         print(bold(red('Starting sequence analysis.')))
-        sequences = sorted(self.get_all_sequences())
+        firstfuture = self.executor.submit(
+            self.get_sequence_values, self.firstsession, 'first database')
+        secondfuture = self.executor.submit(
+            self.get_sequence_values, self.secondsession, 'second database')
+        firstvalues, secondvalues = firstfuture.result(), secondfuture.result()
+        sequences = sorted(firstvalues)
         failures = 0
-        for sequence in sequences:
+        for idx, sequence in enumerate(sequences):
             status_update = StatusUpdate(
                 f"Analysing sequence {sequence}. "
-                f"[{sequences.index(sequence) + 1}/{len(sequences)}]"
+                f"[{idx + 1}/{len(sequences)}]"
             )
-            result, message = self.diff_sequence(sequence)
+            if firstvalues[sequence] is None:
+                result, message = \
+                    False, "no privilege to read sequence in first database."
+            elif sequence not in secondvalues:
+                result, message = \
+                    False, "sequence doesnt exist in second database."
+            elif secondvalues[sequence] is None:
+                result, message = \
+                    False, "no privilege to read sequence in second database."
+            else:
+                result, message = diff_sequence_values(
+                    firstvalues[sequence], secondvalues[sequence])
             status_update.complete(result, f"{sequence} - {message}")
             if result is False:
                 failures += 1
@@ -181,49 +960,159 @@ class DBDiff(object):
     def diff_all_table_data(self):
         failures = 0
 
-        self.create_aggregate_functions()
-
+        for name, recovery in (('First', self.firstrecovery),
+                               ('Second', self.secondrecovery)):
+            if recovery:
+                print(f'{name} database is a hot standby.')
         print(bold(red('Starting table analysis.')))
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", category=sa_exc.SAWarning)
-            tables = sorted(
-                self.firstinspector.get_table_names(schema="public"))
-            for table in tables:
+        tables = sorted(self.firstcatalog)
+        if self.jobs > 1:
+            results = self.map_workers(
+                lambda worker, table: worker.diff_checkpointed_table(table),
+                tables)
+        else:
+            results = (self.diff_checkpointed_table(table)
+                       for table in tables)
+        try:
+            for idx, table in enumerate(tables):
                 status_update = StatusUpdate(
                     f"Analysing table {table}. "
-                    f"[{tables.index(table) + 1}/{len(tables)}]"
+                    f"[{idx + 1}/{len(tables)}]"
                 )
-                result, message = self.diff_table_data(table)
+                result, message = next(results)
                 status_update.complete(result, f"{table} - {message}")
                 if result is False:
                     failures += 1
+        finally:
+            # closes the workers
+            results.close()
         print(bold(green('Table analysis complete.')))
+        if self.checkpoint:
+            self.checkpoint.remove()
         if failures > 0:
             return 1
         return 0
 
-    def create_aggregate_functions(self):
-        print('creating aggregate functions')
-        stmt = """
-        DROP AGGREGATE IF EXISTS public.last(anyelement);
+    def print_pool_stats(self):
+        for name, engine in (('First', self.firstengine),
+                             ('Second', self.secondengine)):
+            print(f'{name} database pool: {engine.pool.stats()}')
 
-        CREATE OR REPLACE FUNCTION public.last_agg ( anyelement, anyelement )
-        RETURNS anyelement LANGUAGE sql IMMUTABLE STRICT AS $$
-                SELECT $2;
-        $$;
 
-        -- And then wrap an aggregate around it
+# the hash, row count and last key of a chunk
+Chunk = namedtuple('Chunk', ['hash', 'count', 'last_key'])
 
-        CREATE AGGREGATE public.last (
-                sfunc    = public.last_agg,
-                basetype = anyelement,
-                stype    = anyelement
-        );
-        """
-        self.firstsession.execute(stmt)
-        self.secondsession.execute(stmt)
-        self.firstsession.commit()
-        self.secondsession.commit()
+
+# the walk through the chunks of a range of a table in key order, shared by
+# DBDiff and AsyncDBDiff, which run its queries and hand it their rows.
+class ChunkScan(object):
+
+    def __init__(self, relation, pks, hash_expr, chunk_size, lower=None,
+                 upper=None, auto=False):
+        self.range_expr = range_filter(pks, lower, upper)
+        self.range_params = {'range_lower': lower, 'range_upper': upper}
+        self.first_statement = chunk_hash_sql(
+            relation, pks, hash_expr, 'true' + self.range_expr)
+        self.next_statement = chunk_hash_sql(
+            relation, pks, hash_expr,
+            key_predicate(pks, '>', 'lower') + self.range_expr)
+        # with auto, the chunk size follows next_chunk_size
+        self.chunk_size = chunk_size
+        self.auto = auto
+        self.limit = chunk_size
+        self.done = False
+        self.position = 0
+        self.last_key = None
+        self.mismatches = []
+        self.skipped = 0
+        # a digest of the hashes of every chunk so far
+        self.digest = ''
+
+    def progress(self):
+        return {'position': self.position, 'last_key': self.last_key,
+                'mismatches': self.mismatches, 'skipped': self.skipped,
+                'digest': self.digest}
+
+    def restore(self, progress):
+        self.position = progress['position']
+        self.last_key = progress['last_key']
+        self.mismatches = progress['mismatches']
+        self.skipped = progress['skipped']
+        self.digest = progress['digest']
+
+    def next_query(self):
+        # the statement and parameters hashing the next chunk
+        self.limit = self.chunk_size
+        params = dict(self.range_params, chunk_size=self.limit)
+        if self.last_key is None:
+            return self.first_statement, params
+        return self.next_statement, dict(
+            params, **key_params('lower', self.last_key))
+
+    def timed(self, elapsed):
+        if self.auto:
+            self.chunk_size = next_chunk_size(self.limit, elapsed)
+
+    def gave_up(self, error):
+        return f"gave up after row {self.position}, keys after " \
+               f"{format_key(self.last_key)}: {error}"
+
+    def check(self, first, second, params):
+        # why the chunks differ, None when they do not
+        if first.hash != second.hash:
+            return f"data hash are different at row {self.position}; " \
+                   f"query params: {params}; " \
+                   f"first: {first.hash}; second: {second.hash}"
+
+        if first.count != second.count:
+            return f"row count are different at row {self.position}; " \
+                   f"query params: {params}; " \
+                   f"first: {first.count}; second: {second.count}"
+
+        if first.last_key != second.last_key:
+            return f"data pks are different  at row {self.position};" \
+                   f"query params: {params}; " \
+                   f"first: {first.last_key}; second: {second.last_key}"
+        return None
+
+    def advance(self, chunk):
+        # past an identical chunk
+        self.position += self.limit
+        self.last_key = chunk.last_key
+        self.digest = hashlib.md5(
+            f'{self.digest}{chunk.hash}'.encode()).hexdigest()
+        # we're done when we have less rows than the limit
+        self.done = chunk.count < self.limit
+
+    def skip(self, count, upper_key):
+        # past a chunk known to be unchanged
+        self.position += count
+        self.last_key = upper_key
+        self.skipped += 1
+
+    def upper_key(self, first, second):
+        # the furthest last key of both sides
+        return max(chunk.last_key for chunk in (first, second)
+                   if chunk.last_key[0] is not None)
+
+    def differ(self, first, second, upper_key, description):
+        # carry on after a different chunk, from upper_key
+        self.mismatches.append(
+            f"keys ({format_key(self.last_key)}, "
+            f"{format_key(upper_key)}]: {description}")
+        self.position += max(first.count, second.count)
+        self.last_key = upper_key
+        self.done = first.count < self.limit and second.count < self.limit
+
+    def result(self, notes=()):
+        if self.mismatches:
+            return False, f"{len(self.mismatches)} chunks are different: " \
+                          + '; '.join(self.mismatches)
+        if self.auto:
+            notes = [f"chunk size {self.chunk_size}"] + list(notes)
+        if notes:
+            return True, f"data is identical ({', '.join(notes)})."
+        return True, "data is identical."
 
 
 class StatusUpdate(object):
@@ -253,24 +1142,293 @@ class StatusUpdate(object):
                 print("warning: ", message)
 
 
-def retry(fn):
+def diff_estimates(firsttable, secondtable):
+    # planner estimates drift apart between databases, so a difference is
+    # only a warning.
+    first_estimate = firsttable.reltuples
+    second_estimate = secondtable.reltuples
+    if first_estimate < 0 or second_estimate < 0:
+        return None, "table was never analyzed"
+    if first_estimate != second_estimate:
+        return None, f"estimated counts are different" \
+            f" {first_estimate} != {second_estimate}"
+    return True, "Estimated counts are the same"
+
+
+def compare_digests(first, second):
+    # see MULTISET_DIGEST_SQL
+    (firstcount, *firstdigest), (secondcount, *seconddigest) = first, second
+    if firstcount != secondcount:
+        return False, f"counts are different {firstcount} != {secondcount}"
+    if firstdigest != seconddigest:
+        return False, "data is different"
+    if firstcount == 0:
+        return None, "tables are empty"
+    return True, "data is identical."
+
+
+def diff_sequence_values(firstvalue, secondvalue):
+    # values are (last_value, is_called), a sequence that was never called
+    # is behind one that was called at the same last_value.
+    def describe(value):
+        last_value, is_called = value
+        return f"{last_value}" if is_called else f"{last_value}, not called"
+
+    if firstvalue < secondvalue:
+        return None, f"first sequence is less than" \
+                     f" the second({describe(firstvalue)} vs" \
+                     f" {describe(secondvalue)})."
+    if firstvalue > secondvalue:
+        return False, f"first sequence is greater than" \
+                      f" the second({describe(firstvalue)} vs" \
+                      f" {describe(secondvalue)})."
+    return True, f"sequences are identical- ({describe(firstvalue)})."
+
+
+def read_chunk(row):
+    # a row of chunk_hash_sql
+    (hash, count, *last_key) = row
+    return Chunk(hash, count, list(row_key(last_key)))
+
+
+def describe_counts(first, second):
+    return f"first: {first.count} rows; second: {second.count} rows"
+
+
+def compare_counts(firstcount, secondcount):
+    if firstcount != secondcount:
+        return False, f"counts are different" \
+            f" {firstcount} != {secondcount}"
+    if firstcount == 0:
+        return None, "tables are empty"
+    return True, "Counts are the same"
+
+
+def partition_bounds(values, partitions):
+    # the values splitting values, sorted, into that many ranges
+    return [values[len(values) * i // partitions]
+            for i in range(1, partitions)]
+
+
+def combine_ranges(ranges, results):
+    # the result of a table from the results of its --partitions ranges
+    failures = [
+        f"range [{lower}, {upper}): {message}"
+        for (lower, upper), (result, message) in zip(ranges, results)
+        if result is not True
+    ]
+    if failures:
+        return False, '; '.join(failures)
+    return True, f"data is identical ({len(ranges)} ranges)."
+
+
+def initial_chunk_size(table):
+    width = table.width
+    if not width or width < 0:
+        return AUTO_CHUNK_SIZE_START
+    return clamp_chunk_size(AUTO_CHUNK_BYTES / width)
+
+
+def clamp_chunk_size(size):
+    return int(min(max(size, AUTO_CHUNK_SIZE_MIN), AUTO_CHUNK_SIZE_MAX))
+
+
+def next_chunk_size(chunk_size, elapsed):
+    # scale towards AUTO_CHUNK_SECONDS per chunk, at most doubling or
+    # halving at a time so one slow or fast chunk doesn't throw it off.
+    factor = AUTO_CHUNK_SECONDS / max(elapsed, 0.001)
+    return clamp_chunk_size(chunk_size * min(max(factor, 0.5), 2))
+
+
+def range_filter(pks, lower, upper):
+    # bounds of a --partitions range, on the first primary key column
+    range_expr = ''
+    if lower is not None:
+        range_expr += f' AND {quote_ident(pks[0])} >= :range_lower'
+    if upper is not None:
+        range_expr += f' AND {quote_ident(pks[0])} < :range_upper'
+    return range_expr
+
+
+def chunk_hash_sql(relation, pks, hash_expr, where_expr):
+    # the last key of the chunk is read from the primary key index, right
+    # after hashing the chunk, in the same statement.
+    order_expr = ', '.join(map(quote_ident, pks))
+    return f"""
+    SELECT chunk.hash, chunk.count, last_key.*
+    FROM
+        (
+            SELECT
+                {hash_expr} as hash,
+                count(*) as count
+            FROM
+                (
+                    SELECT * from {relation}
+                    WHERE {where_expr}
+                    ORDER BY {order_expr}
+                    LIMIT :chunk_size
+                ) t
+        ) chunk
+        LEFT JOIN LATERAL
+        (
+            SELECT {order_expr} from {relation}
+            WHERE {where_expr}
+            ORDER BY {order_expr}
+            OFFSET greatest(chunk.count - 1, 0) LIMIT 1
+        ) last_key ON true;
+    """
+
+
+def split_ranges(bounds):
+    bounds = sorted(set(bounds))
+    return list(zip([None] + bounds, bounds + [None]))
+
+
+def quote_ident(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def key_predicate(pks, operator, name):
+    placeholders = ', '.join(f':{name}_{idx}' for idx in range(len(pks)))
+    return f"({', '.join(map(quote_ident, pks))}) {operator} ({placeholders})"
+
+
+def key_params(name, key):
+    return {f'{name}_{idx}': value for idx, value in enumerate(key)}
+
+
+def key_range_filter(pks, lower_key, upper_key, range_expr='',
+                     range_params=None):
+    # the condition and parameters selecting the keys in
+    # (lower_key, upper_key], lower_key None meaning from the start
+    where_expr = key_predicate(pks, '<=', 'upper') + range_expr
+    params = dict(range_params or {}, **key_params('upper', upper_key))
+    if lower_key is not None:
+        where_expr += ' AND ' + key_predicate(pks, '>', 'lower')
+        params.update(key_params('lower', lower_key))
+    return where_expr, params
+
+
+def base_type(coltype):
+    # the type without its modifiers, e.g. numeric for numeric(10,2)
+    return re.sub(r'\(.*?\)', '', coltype)
+
+
+def order_column(column, coltype):
+    # text is ordered bytewise, the way python compares strings
+    if base_type(coltype) in COLLATABLE_TYPES:
+        return f'{quote_ident(column)} COLLATE "C"'
+    return quote_ident(column)
+
+
+def row_key(values):
+    # bytea comes as memoryview, which python does not order
+    return tuple(bytes(value) if isinstance(value, memoryview) else value
+                 for value in values)
+
+
+def stream_rows(result, key_length):
+    # (key, values) of every row of result
+    for row in result:
+        yield row_key(row[:key_length]), tuple(row[key_length:])
+
+
+def merge_rows(firstrows, secondrows):
+    # both sides must be in the same key order
+    first = next(firstrows, None)
+    second = next(secondrows, None)
+    while first is not None or second is not None:
+        if second is None or first is not None and first[0] < second[0]:
+            yield RowDiff('missing', first[0], first[1], None)
+            first = next(firstrows, None)
+        elif first is None or second[0] < first[0]:
+            yield RowDiff('extra', second[0], None, second[1])
+            second = next(secondrows, None)
+        else:
+            if first[1] != second[1]:
+                yield RowDiff('changed', first[0], first[1], second[1])
+            first = next(firstrows, None)
+            second = next(secondrows, None)
+
+
+def compare_row_hashes(firstrows, secondrows):
+    # keys are listed in the order of the rows of the first side, then of
+    # the second, as read from the databases rather than sorted by python
+    diffs = []
+    for key in list(firstrows) + [key for key in secondrows
+                                  if key not in firstrows]:
+        if key not in secondrows:
+            diffs.append(RowDiff('missing', key, None, None))
+        elif key not in firstrows:
+            diffs.append(RowDiff('extra', key, None, None))
+        elif firstrows[key] != secondrows[key]:
+            diffs.append(RowDiff('changed', key, None, None))
+    return diffs
+
+
+def format_key(key):
+    if key is None:
+        return 'start'
+    if len(key) == 1:
+        return str(key[0])
+    return str(tuple(key))
+
+
+def describe_row_diffs(diffs, columns=None):
+    # the columns of changed rows are listed when their values are known
+    if not diffs:
+        return "no rows differ anymore"
+    descriptions = {
+        'missing': 'missing from second',
+        'extra': 'extra in second',
+        'changed': 'changed',
+    }
+    parts = []
+    for kind, description in descriptions.items():
+        keys = [format_key(diff.key) + changed_columns(diff, columns)
+                for diff in diffs if diff.kind == kind]
+        if keys:
+            parts.append(f"{description}: {', '.join(keys)}")
+    return '; '.join(parts)
+
+
+def changed_columns(diff, columns):
+    if diff.kind != 'changed' or diff.first is None or columns is None:
+        return ''
+    changed = [column for column, first, second
+               in zip(columns, diff.first, diff.second) if first != second]
+    return f" ({', '.join(changed)})"
+
+
+def retry(fn, name='database', session=None):
+    # the session is rolled back before retrying, as its transaction is
+    # aborted (or its connection gone) after an error
     i = 0
-    max_tries = 3
-    base_timeout = 1
     while True:
         try:
             return fn()
         except Exception as ex:
-            if (not isinstance(ex, DatabaseError) and
-                    not isinstance(ex, OperationalError)):
-                raise
-            print('operational error running query:', ex)
-            if i < max_tries:
-                delay = 2**i * base_timeout
-                print(
-                    f'Attempt {i+1} of {max_tries}, retrying in {delay} secs.'
-                )
-                time.sleep(delay)
-            else:
-                raise
+            delay = retry_delay(ex, name, i)
+            if session is not None:
+                session.rollback()
+            time.sleep(delay)
             i += 1
+
+
+def retry_delay(ex, name, i, max_tries=3, base_timeout=1):
+    # how long to wait before the retry following the i-th error, ex raised
+    # again when it is not a database error or the tries ran out
+    if (not isinstance(ex, DatabaseError) and
+            not isinstance(ex, OperationalError)):
+        raise ex
+    print(f'operational error running query on {name}:',
+          getattr(ex, 'orig', ex))
+    if i >= max_tries:
+        raise ex
+    # jittered, so workers failing together do not retry together
+    delay = random.uniform(0.5, 1) * 2**i * base_timeout
+    print(
+        f'Attempt {i+1} of {max_tries}, '
+        f'retrying in {delay:.1f} secs.'
+    )
+    return delay
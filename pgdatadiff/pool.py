@@ -0,0 +1,50 @@
+import threading
+import time
+
+from sqlalchemy.pool import QueuePool
+
+
+# a QueuePool that counts checkouts, and how often and how long they had to
+# wait for a connection because every one of them was in use.
+class StatsPool(QueuePool):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.checkouts = 0
+            self.waits = 0
+            self.wait_time = 0.0
+
+    def _do_get(self):
+        exhausted = self.checkedin() == 0 and \
+            self._overflow >= self._max_overflow
+        started = time.monotonic()
+        try:
+            return super()._do_get()
+        finally:
+            with self.stats_lock:
+                self.checkouts += 1
+                if exhausted:
+                    self.waits += 1
+                    self.wait_time += time.monotonic() - started
+
+    def stats(self):
+        return f"{self.size()} connections, {self.checkouts} checkouts, " \
+               f"{self.waits} waits ({self.wait_time:.2f}s waiting)"
+
+
+def prewarm(engine, size):
+    # opens every connection of the pool up front, instead of one by one in
+    # the middle of the first tables
+    connections = []
+    try:
+        for _ in range(size):
+            connections.append(engine.connect())
+    finally:
+        for connection in connections:
+            connection.close()
+    engine.pool.reset_stats()
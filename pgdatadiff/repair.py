@@ -0,0 +1,106 @@
+import os
+import re
+import threading
+from collections import defaultdict
+
+from psycopg2.extensions import quote_ident
+
+REPAIR_TABLE = 'pgdatadiff_repair'
+
+
+def batches(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def quote_idents(cursor, names):
+    return ', '.join(quote_ident(name, cursor) for name in names)
+
+
+def key_condition(cursor, table, keys):
+    # a condition selecting the rows with the given primary keys
+    pks = table.pks
+    if len(pks) == 1:
+        coltype = table.types[table.columns.index(pks[0])]
+        return cursor.mogrify(
+            f"{quote_idents(cursor, pks)} = ANY(%s::{coltype}[])",
+            ([key[0] for key in keys],)).decode()
+    return cursor.mogrify(
+        f"({quote_idents(cursor, pks)}) IN %s",
+        (tuple(tuple(key) for key in keys),)).decode()
+
+
+# the rows to fix on the second database, by table: the extra rows are
+# deleted, then the missing and changed ones are copied from the first
+# database and upserted.
+class Repair(object):
+
+    def __init__(self, directory, batch_size=1000):
+        self.directory = directory
+        self.batch_size = int(batch_size)
+        self.lock = threading.Lock()
+        self.upserts = defaultdict(list)
+        self.deletes = defaultdict(list)
+        os.makedirs(directory, exist_ok=True)
+
+    def add(self, tablename, diffs):
+        with self.lock:
+            for diff in diffs:
+                if diff.kind == 'extra':
+                    self.deletes[tablename].append(diff.key)
+                else:
+                    self.upserts[tablename].append(diff.key)
+
+    def write(self, connection, tablename, table):
+        # writes <table>.copy, the rows to upsert read from the first
+        # database, and <table>.sql, which applies the deletes and them.
+        # Returns the name of the script, None when there is nothing to fix.
+        with self.lock:
+            upserts = self.upserts.pop(tablename, [])
+            deletes = self.deletes.pop(tablename, [])
+        if not upserts and not deletes:
+            return None
+
+        name = re.sub(r'[^\w.-]', '_', tablename)
+        cursor = connection.cursor()
+        columns = quote_idents(cursor, table.columns)
+        with open(os.path.join(self.directory, f'{name}.copy'), 'w') as f:
+            for batch in batches(upserts, self.batch_size):
+                cursor.copy_expert(
+                    f"COPY (SELECT {columns} FROM {table.qualified} "
+                    f"WHERE {key_condition(cursor, table, batch)}) "
+                    f"TO STDOUT", f)
+
+        updates = ', '.join(
+            f'{quote_ident(column, cursor)} = '
+            f'EXCLUDED.{quote_ident(column, cursor)}'
+            for column in table.columns if column not in table.pks)
+        conflict = f"DO UPDATE SET {updates}" if updates else "DO NOTHING"
+        lines = [
+            f"-- {tablename}: {len(upserts)} rows to insert or update, "
+            f"{len(deletes)} rows to delete.",
+            "-- run with psql from this directory.",
+            "BEGIN;",
+        ]
+        # deleted first, so that the rows upserted never conflict with the
+        # unique values of rows about to be deleted
+        for batch in batches(deletes, self.batch_size):
+            lines.append(f"DELETE FROM {table.qualified} "
+                         f"WHERE {key_condition(cursor, table, batch)};")
+        if upserts:
+            lines += [
+                f"CREATE TEMPORARY TABLE {REPAIR_TABLE} "
+                f"(LIKE {table.qualified}) ON COMMIT DROP;",
+                f"\\copy {REPAIR_TABLE} ({columns}) FROM '{name}.copy'",
+                f"INSERT INTO {table.qualified} ({columns})",
+                f"    SELECT {columns} FROM {REPAIR_TABLE}",
+                f"    ON CONFLICT "
+                f"({quote_idents(cursor, table.pks)}) {conflict};",
+            ]
+        lines.append("COMMIT;")
+        cursor.close()
+
+        script = os.path.join(self.directory, f'{name}.sql')
+        with open(script, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return script
@@ -21,4 +21,7 @@ setup(
         'fabulous<=0.3.0',
         'docopt<=0.6.2'
     ],
+    extras_require={
+        'async': ['asyncpg'],
+    },
 )
@@ -1,3 +1,4 @@
 #!/usr/bin/env bash
 
-echo "nothing to do"
+# set PGDATADIFF_TEST_DSN to a scratch database to also check query plans
+python -m pytest -q tests
@@ -0,0 +1,140 @@
+import struct
+import threading
+
+import pytest
+
+from pgdatadiff import binarycopy
+from pgdatadiff.binarycopy import (
+    COPY_SIGNATURE, KEY_DECODERS, copy_rows, parse_copy, split_values)
+
+
+def encode_copy(rows, extension=b''):
+    # binary COPY data of rows of values, given as bytes or None for NULL
+    data = COPY_SIGNATURE + struct.pack('!ii', 0, len(extension)) + extension
+    for row in rows:
+        data += struct.pack('!h', len(row))
+        for value in row:
+            if value is None:
+                data += struct.pack('!i', -1)
+            else:
+                data += struct.pack('!i', len(value)) + value
+    return data + struct.pack('!h', -1)
+
+
+ROWS = [
+    (struct.pack('!i', 1), b'abc', None),
+    (struct.pack('!i', 2), b'', b'de'),
+    (struct.pack('!i', 300), None, b'f' * 40),
+]
+
+EXPECTED = [
+    ((1,), struct.pack('!i', 3) + b'abc' + struct.pack('!i', -1)),
+    ((2,), struct.pack('!i', 0) + struct.pack('!i', 2) + b'de'),
+    ((300,), struct.pack('!i', -1) + struct.pack('!i', 40) + b'f' * 40),
+]
+
+DECODERS = [KEY_DECODERS['integer']]
+
+
+def test_parse_copy_split_at_every_byte():
+    data = encode_copy(ROWS)
+    for cut in range(len(data) + 1):
+        assert list(parse_copy([data[:cut], data[cut:]], DECODERS)) == \
+            EXPECTED, cut
+
+
+def test_parse_copy_one_byte_at_a_time():
+    data = encode_copy(ROWS, extension=b'ext')
+    chunks = [data[i:i + 1] for i in range(len(data))]
+    assert list(parse_copy(chunks, DECODERS)) == EXPECTED
+
+
+def test_parse_copy_composite_key():
+    data = encode_copy([(struct.pack('!q', 7), b'k1', b'v')])
+    decoders = [KEY_DECODERS['bigint'], KEY_DECODERS['text']]
+    for cut in range(len(data) + 1):
+        assert list(parse_copy([data[:cut], data[cut:]], decoders)) == \
+            [((7, 'k1'), struct.pack('!i', 1) + b'v')]
+
+
+def test_parse_copy_truncated():
+    data = encode_copy(ROWS)
+    for cut in range(len(data) - 1):
+        with pytest.raises(EOFError):
+            list(parse_copy([data[:cut]], DECODERS))
+
+
+def test_parse_copy_not_binary():
+    with pytest.raises(ValueError):
+        list(parse_copy([b'1\tabc\n' * 4], DECODERS))
+
+
+def test_split_values():
+    assert [split_values(values) for _, values in EXPECTED] == [
+        (b'abc', None), (b'', b'de'), (None, b'f' * 40)]
+
+
+class FakeCursor(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def mogrify(self, statement, params):
+        return statement.encode()
+
+    def copy_expert(self, statement, f):
+        try:
+            for index in range(len(self.connection.data)):
+                if self.connection.cancelled.is_set():
+                    raise RuntimeError('canceling statement')
+                f.write(self.connection.data[index:index + 1])
+        finally:
+            self.connection.finished.set()
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    # writes data a byte at a time, the way psycopg2 writes COPY data a
+    # row at a time
+
+    def __init__(self, data):
+        self.data = data
+        self.cancelled = threading.Event()
+        self.finished = threading.Event()
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+@pytest.fixture
+def small_batches(monkeypatch):
+    monkeypatch.setattr(binarycopy, 'COPY_BATCH_SIZE', 1)
+    monkeypatch.setattr(binarycopy, 'COPY_QUEUE_SIZE', 1)
+
+
+def test_copy_rows(small_batches):
+    connection = FakeConnection(encode_copy(ROWS))
+    assert list(copy_rows(connection, 'SELECT', {}, DECODERS)) == EXPECTED
+    assert connection.finished.is_set()
+    assert not connection.cancelled.is_set()
+
+
+def test_copy_rows_stopped_early(small_batches):
+    connection = FakeConnection(encode_copy(ROWS * 100))
+    rows = copy_rows(connection, 'SELECT', {}, DECODERS)
+    assert next(rows) == EXPECTED[0]
+    rows.close()
+    assert connection.cancelled.is_set()
+    assert connection.finished.is_set()
+
+
+def test_copy_rows_error(small_batches):
+    connection = FakeConnection(b'1\tabc\n' * 4)
+    with pytest.raises(ValueError):
+        list(copy_rows(connection, 'SELECT', {}, DECODERS))
+    assert connection.finished.is_set()
@@ -0,0 +1,48 @@
+from pgdatadiff.cache import ChunkCache
+
+
+def test_ranges_do_not_collide(tmp_path):
+    cache = ChunkCache(str(tmp_path / 'cache.sqlite'), 'a b')
+    cache.open_table('public.users', '1:0/1:0')
+    # the first chunk of every --partitions range starts after no key
+    cache.put('public.users', (None, 100), None, [50], 'h1', 50)
+    cache.put('public.users', (100, None), None, [150], 'h2', 50)
+    assert cache.get('public.users', (None, 100), None) == ([50], 50)
+    assert cache.get('public.users', (100, None), None) == ([150], 50)
+    assert cache.get('public.users', (None, None), None) is None
+
+
+def test_chunks_are_kept_per_pair_of_databases(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    cache = ChunkCache(path, 'a b')
+    cache.open_table('public.users', '1:0/1:0')
+    cache.put('public.users', (None, None), [10], [20], 'h', 10)
+    assert ChunkCache(path, 'a b').get(
+        'public.users', (None, None), [10]) == ([20], 10)
+    assert ChunkCache(path, 'a c').get(
+        'public.users', (None, None), [10]) is None
+
+
+def test_watermark_change_forgets_chunks(tmp_path):
+    cache = ChunkCache(str(tmp_path / 'cache.sqlite'), 'a b')
+    cache.open_table('public.users', '1:0/1:0')
+    cache.open_table('public.pairs', '2:0/2:0')
+    cache.put('public.users', (None, None), None, [10], 'h', 10)
+    cache.put('public.pairs', (None, None), None, [10], 'h', 10)
+
+    cache.open_table('public.users', '1:0/1:0')
+    assert cache.get('public.users', (None, None), None) == ([10], 10)
+
+    # rows were updated or deleted on the second database
+    cache.open_table('public.users', '1:0/1:3')
+    assert cache.get('public.users', (None, None), None) is None
+    assert cache.get('public.pairs', (None, None), None) == ([10], 10)
+
+
+def test_keys_keep_their_types(tmp_path):
+    cache = ChunkCache(str(tmp_path / 'cache.sqlite'), 'a b')
+    cache.open_table('public.files', '1:0/1:0')
+    cache.put('public.files', (None, None), [b'\x00\x01'], [b'\x00\xff'],
+              'h', 10)
+    assert cache.get('public.files', (None, None), [b'\x00\x01']) == \
+        ([b'\x00\xff'], 10)
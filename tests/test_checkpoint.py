@@ -0,0 +1,71 @@
+import datetime
+import decimal
+import json
+import uuid
+
+import pytest
+
+from pgdatadiff import checkpoint
+from pgdatadiff.checkpoint import Checkpoint
+
+
+def test_progress_is_saved_every_interval(tmp_path, monkeypatch):
+    path = str(tmp_path / 'checkpoint.json')
+    saved = Checkpoint(path)
+    saved.put_progress('public.users', None, None, {'position': 1})
+    assert not (tmp_path / 'checkpoint.json').exists()
+
+    monkeypatch.setattr(checkpoint, 'SAVE_INTERVAL', 0)
+    saved.put_progress('public.users', None, None, {'position': 2})
+    resumed = Checkpoint(path, resume=True)
+    assert resumed.get_progress('public.users', None, None) == \
+        {'position': 2}
+
+
+def test_tables_are_saved_right_away(tmp_path):
+    path = str(tmp_path / 'checkpoint.json')
+    saved = Checkpoint(path)
+    saved.put_ranges('public.users', [[None, 10], [10, None]])
+    saved.put_progress('public.users', 10, None, {'position': 1})
+    saved.put_table('public.users', True, 'data is identical.')
+    with open(path) as f:
+        state = json.load(f)
+    assert state['tables'] == {'public.users': [True, 'data is identical.']}
+    assert state['progress'] == {}
+
+    resumed = Checkpoint(path, resume=True)
+    assert resumed.get_table('public.users') == [True, 'data is identical.']
+    assert resumed.get_ranges('public.users') == [[None, 10], [10, None]]
+    resumed.remove()
+    assert not (tmp_path / 'checkpoint.json').exists()
+
+
+def test_not_resumed(tmp_path):
+    path = str(tmp_path / 'checkpoint.json')
+    Checkpoint(path).put_table('public.users', False, 'data is different')
+    assert Checkpoint(path).get_table('public.users') is None
+
+
+def test_keys_keep_their_types(tmp_path):
+    path = str(tmp_path / 'checkpoint.json')
+    key = [b'\x00\xff', datetime.date(2020, 2, 29),
+           datetime.datetime(2020, 2, 29, 12, 30, 1, 5,
+                             tzinfo=datetime.timezone.utc),
+           uuid.UUID('12345678-1234-5678-1234-567812345678'),
+           decimal.Decimal('1.50'), 'text', 7, None]
+    saved = Checkpoint(path)
+    saved.put_ranges('public.users', [[None, key[1]], [key[1], None]])
+    saved.put_progress('public.users', key[1], None, {'last_key': key})
+    saved.put_table('public.pairs', True, 'data is identical.')
+
+    resumed = Checkpoint(path, resume=True)
+    assert resumed.get_ranges('public.users') == \
+        [[None, key[1]], [key[1], None]]
+    assert resumed.get_progress('public.users', key[1], None) == \
+        {'last_key': key}
+
+
+def test_unknown_key_types_are_refused(tmp_path):
+    saved = Checkpoint(str(tmp_path / 'checkpoint.json'))
+    with pytest.raises(TypeError):
+        saved.put_ranges('public.users', [[None, object()]])
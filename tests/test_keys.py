@@ -0,0 +1,75 @@
+import os
+
+import pytest
+
+from pgdatadiff.pgdatadiff import (
+    HASH_ALGORITHMS, chunk_hash_sql, key_params, key_predicate,
+    key_range_filter)
+
+# a database to create a scratch table in, e.g.
+# postgres://postgres@localhost/pgdatadiff_test
+TEST_DSN = os.environ.get('PGDATADIFF_TEST_DSN')
+
+
+def test_key_predicate():
+    assert key_predicate(['id'], '>', 'lower') == '("id") > (:lower_0)'
+
+
+def test_key_predicate_composite():
+    assert key_predicate(['a', 'b"c'], '<=', 'upper') == \
+        '("a", "b""c") <= (:upper_0, :upper_1)'
+
+
+def test_key_params():
+    assert key_params('lower', [1, 'x']) == {'lower_0': 1, 'lower_1': 'x'}
+
+
+def test_key_range_filter_from_start():
+    assert key_range_filter(['a', 'b'], None, (5, 'k')) == (
+        '("a", "b") <= (:upper_0, :upper_1)',
+        {'upper_0': 5, 'upper_1': 'k'})
+
+
+def test_key_range_filter():
+    assert key_range_filter(['a', 'b'], (1, 'j'), (5, 'k')) == (
+        '("a", "b") <= (:upper_0, :upper_1) AND '
+        '("a", "b") > (:lower_0, :lower_1)',
+        {'upper_0': 5, 'upper_1': 'k', 'lower_0': 1, 'lower_1': 'j'})
+
+
+def test_key_range_filter_partition():
+    where_expr, params = key_range_filter(
+        ['id'], (1,), (20,), ' AND "id" >= :range_lower',
+        {'range_lower': 0, 'range_upper': None})
+    assert where_expr == '("id") <= (:upper_0) AND "id" >= :range_lower ' \
+                         'AND ("id") > (:lower_0)'
+    assert params == {'range_lower': 0, 'range_upper': None,
+                      'upper_0': 20, 'lower_0': 1}
+
+
+@pytest.mark.skipif(TEST_DSN is None, reason='PGDATADIFF_TEST_DSN is not set')
+def test_chunk_hash_sql_uses_index():
+    from sqlalchemy import create_engine, text
+
+    engine = create_engine(TEST_DSN)
+    with engine.connect() as connection:
+        transaction = connection.begin()
+        try:
+            connection.execute(
+                "CREATE TEMPORARY TABLE keyset (a int, b text, v text, "
+                "PRIMARY KEY (a, b));")
+            connection.execute(
+                "INSERT INTO keyset SELECT mod(g, 1000), 'k' || g, 'v' "
+                "FROM generate_series(1, 100000) g;")
+            connection.execute("ANALYZE keyset;")
+            statement = chunk_hash_sql(
+                'keyset', ['a', 'b'], HASH_ALGORITHMS['md5'],
+                key_predicate(['a', 'b'], '>', 'lower'))
+            plan = '\n'.join(row[0] for row in connection.execute(
+                text(f"EXPLAIN {statement}"),
+                dict(key_params('lower', [500, 'k500']), chunk_size=1000)))
+        finally:
+            transaction.rollback()
+    assert 'Index Scan using keyset_pkey' in plan \
+        or 'Index Only Scan using keyset_pkey' in plan
+    assert 'Seq Scan' not in plan
@@ -0,0 +1,127 @@
+import pytest
+
+from pgdatadiff import repair
+from pgdatadiff.pgdatadiff import RowDiff, TableInfo
+from pgdatadiff.repair import Repair, key_condition
+
+
+class StubCursor(object):
+
+    def __init__(self):
+        self.copies = []
+
+    def mogrify(self, statement, params):
+        return (statement % tuple(map(repr, params))).encode()
+
+    def copy_expert(self, statement, f):
+        self.copies.append(statement)
+        f.write('row\n')
+
+    def close(self):
+        pass
+
+
+class StubConnection(object):
+
+    def __init__(self):
+        self.cursors = []
+
+    def cursor(self):
+        cursor = StubCursor()
+        self.cursors.append(cursor)
+        return cursor
+
+
+@pytest.fixture(autouse=True)
+def quote_ident(monkeypatch):
+    # psycopg2 only quotes with a real connection
+    monkeypatch.setattr(
+        repair, 'quote_ident',
+        lambda name, cursor: '"' + name.replace('"', '""') + '"')
+
+
+def table(columns, types, pks):
+    return TableInfo('public', 'users', 'public.users', columns, types, pks,
+                     100, 32, True)
+
+
+USERS = table(['id', 'name'], ['integer', 'text'], ['id'])
+PAIRS = table(['a', 'b'], ['integer', 'text'], ['a', 'b'])
+
+
+def test_key_condition_single_column():
+    assert key_condition(StubCursor(), USERS, [(1,), (2,)]) == \
+        '"id" = ANY([1, 2]::integer[])'
+
+
+def test_key_condition_composite():
+    assert key_condition(StubCursor(), PAIRS, [(1, 'x'), (2, 'y')]) == \
+        '("a", "b") IN ((1, \'x\'), (2, \'y\'))'
+
+
+def test_write(tmp_path):
+    fix = Repair(str(tmp_path), batch_size=2)
+    fix.add('public.users', [
+        RowDiff('missing', (1,), None, None),
+        RowDiff('extra', (2,), None, None),
+        RowDiff('changed', (3,), None, None),
+        RowDiff('missing', (4,), None, None),
+    ])
+    connection = StubConnection()
+    script = fix.write(connection, 'public.users', USERS)
+    assert script == str(tmp_path / 'public.users.sql')
+    with open(script) as f:
+        lines = f.read().splitlines()
+
+    delete = lines.index(
+        'DELETE FROM public.users WHERE "id" = ANY([2]::integer[]);')
+    insert = lines.index('INSERT INTO public.users ("id", "name")')
+    # deleted first, then upserted
+    assert delete < insert
+    assert "\\copy pgdatadiff_repair (\"id\", \"name\") " \
+        "FROM 'public.users.copy'" in lines
+    assert lines[insert + 2] == \
+        '    ON CONFLICT ("id") DO UPDATE SET "name" = EXCLUDED."name";'
+    assert lines[-1] == 'COMMIT;'
+
+    # the rows to upsert, read in batches of batch_size
+    assert connection.cursors[0].copies == [
+        'COPY (SELECT "id", "name" FROM public.users '
+        'WHERE "id" = ANY([1, 3]::integer[])) TO STDOUT',
+        'COPY (SELECT "id", "name" FROM public.users '
+        'WHERE "id" = ANY([4]::integer[])) TO STDOUT',
+    ]
+    assert (tmp_path / 'public.users.copy').read_text() == 'row\nrow\n'
+    # only written once
+    assert fix.write(StubConnection(), 'public.users', USERS) is None
+
+
+def test_write_key_columns_only(tmp_path):
+    fix = Repair(str(tmp_path))
+    fix.add('public.users', [RowDiff('missing', (1, 'x'), None, None)])
+    with open(fix.write(StubConnection(), 'public.users', PAIRS)) as f:
+        lines = f.read().splitlines()
+    assert '    ON CONFLICT ("a", "b") DO NOTHING;' in lines
+    assert not [line for line in lines if line.startswith('DELETE')]
+
+
+def test_write_deletes_only(tmp_path):
+    fix = Repair(str(tmp_path))
+    fix.add('public.users', [RowDiff('extra', (1, 'x'), None, None),
+                             RowDiff('extra', (2, 'y'), None, None)])
+    connection = StubConnection()
+    with open(fix.write(connection, 'public.users', PAIRS)) as f:
+        lines = f.read().splitlines()
+    assert lines[2:] == [
+        'BEGIN;',
+        'DELETE FROM public.users '
+        'WHERE ("a", "b") IN ((1, \'x\'), (2, \'y\'));',
+        'COMMIT;',
+    ]
+    assert connection.cursors[0].copies == []
+
+
+def test_write_nothing(tmp_path):
+    fix = Repair(str(tmp_path))
+    fix.add('public.users', [])
+    assert fix.write(StubConnection(), 'public.users', USERS) is None
@@ -0,0 +1,99 @@
+from pgdatadiff.pgdatadiff import (
+    RowDiff, changed_columns, compare_row_hashes, describe_row_diffs,
+    merge_rows)
+
+COLUMNS = ['id', 'name', 'age']
+
+
+def rows(*rows):
+    # (key, values) of rows given as (id, name, age)
+    return iter([((row[0],), row) for row in rows])
+
+
+def test_merge_rows():
+    first = rows((1, 'a', 10), (2, 'b', 20), (4, 'd', 40), (6, 'f', 60))
+    second = rows((2, 'b', 20), (3, 'c', 30), (4, 'd', 41), (7, 'g', 70))
+    assert list(merge_rows(first, second)) == [
+        RowDiff('missing', (1,), (1, 'a', 10), None),
+        RowDiff('extra', (3,), None, (3, 'c', 30)),
+        RowDiff('changed', (4,), (4, 'd', 40), (4, 'd', 41)),
+        RowDiff('missing', (6,), (6, 'f', 60), None),
+        RowDiff('extra', (7,), None, (7, 'g', 70)),
+    ]
+
+
+def test_merge_rows_identical():
+    assert list(merge_rows(rows((1, 'a', 10), (2, 'b', 20)),
+                           rows((1, 'a', 10), (2, 'b', 20)))) == []
+
+
+def test_merge_rows_one_side_empty():
+    assert list(merge_rows(rows((1, 'a', 10), (2, 'b', 20)), rows())) == [
+        RowDiff('missing', (1,), (1, 'a', 10), None),
+        RowDiff('missing', (2,), (2, 'b', 20), None),
+    ]
+    assert list(merge_rows(rows(), rows((1, 'a', 10)))) == [
+        RowDiff('extra', (1,), None, (1, 'a', 10)),
+    ]
+    assert list(merge_rows(rows(), rows())) == []
+
+
+def test_merge_rows_composite_key():
+    first = iter([((1, 'a'), ('x',)), ((1, 'c'), ('y',)), ((2, 'a'), ('z',))])
+    second = iter([((1, 'b'), ('x',)), ((1, 'c'), ('y',)),
+                   ((2, 'a'), ('w',))])
+    assert [(diff.kind, diff.key) for diff in merge_rows(first, second)] == [
+        ('missing', (1, 'a')), ('extra', (1, 'b')), ('changed', (2, 'a'))]
+
+
+def test_compare_row_hashes():
+    first = {(3,): 'h3', (1,): 'h1', (2,): 'h2'}
+    second = {(5,): 'h5', (2,): 'x2', (1,): 'h1', (4,): 'h4'}
+    # in the order of the first side, then of the second
+    assert compare_row_hashes(first, second) == [
+        RowDiff('missing', (3,), None, None),
+        RowDiff('changed', (2,), None, None),
+        RowDiff('extra', (5,), None, None),
+        RowDiff('extra', (4,), None, None),
+    ]
+
+
+def test_compare_row_hashes_one_side_empty():
+    assert compare_row_hashes({(1,): 'h1'}, {}) == [
+        RowDiff('missing', (1,), None, None)]
+    assert compare_row_hashes({}, {(1,): 'h1'}) == [
+        RowDiff('extra', (1,), None, None)]
+    assert compare_row_hashes({}, {}) == []
+
+
+def test_changed_columns():
+    diff = RowDiff('changed', (4,), (4, 'd', 40), (4, 'e', 41))
+    assert changed_columns(diff, COLUMNS) == ' (name, age)'
+    # unknown values or columns, as with --bisect
+    assert changed_columns(diff._replace(first=None, second=None),
+                           COLUMNS) == ''
+    assert changed_columns(diff, None) == ''
+    assert changed_columns(
+        RowDiff('missing', (1,), (1, 'a', 10), None), COLUMNS) == ''
+
+
+def test_describe_row_diffs():
+    diffs = [
+        RowDiff('extra', (3,), None, (3, 'c', 30)),
+        RowDiff('missing', (1,), (1, 'a', 10), None),
+        RowDiff('changed', (4,), (4, 'd', 40), (4, 'd', 41)),
+        RowDiff('missing', (6,), (6, 'f', 60), None),
+    ]
+    assert describe_row_diffs(diffs, COLUMNS) == (
+        "missing from second: 1, 6; extra in second: 3; changed: 4 (age)")
+    assert describe_row_diffs(diffs) == (
+        "missing from second: 1, 6; extra in second: 3; changed: 4")
+
+
+def test_describe_row_diffs_composite_key():
+    assert describe_row_diffs([RowDiff('changed', (1, 'a'), None, None)]) \
+        == "changed: (1, 'a')"
+
+
+def test_describe_row_diffs_none():
+    assert describe_row_diffs([]) == "no rows differ anymore"